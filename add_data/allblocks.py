@@ -1,34 +1,28 @@
-"""Create DB tables and input rows for tables."""
-
-from sqlalchemy import create_engine, func, text
-from sqlalchemy.orm import sessionmaker
+"""Sum the severity of every block over the last year from the incident cube
+and store it as this month's predictions under MODEL_VERSION."""
 
 from decouple import config
-from functools import partial
-
-from shapely import wkb, wkt
-from shapely.geometry import shape
-from shapely.geometry.multipolygon import MultiPolygon
-from shapely.ops import transform
 
-import shapefile
-import pyproj
-
-import numpy as np
 import pandas as pd
 
 from models import *
+from cube import severity_query
+from db import engine, print_report, raw_connection
+from predictions import read_predictions, update_blocks, write_predictions
+from tensors import severity_tensor
 
-import json
 import datetime
-import io
-import os
+import time
 
 # Read/write DB URI
 DB_URI  = config('DB_URI')
-ENGINE  = create_engine(DB_URI)
-Session = sessionmaker(bind=ENGINE)
-SESSION = Session()
+ENGINE  = engine(DB_URI)
+
+# Version and encoding the predictions of this run are stored under, and
+# whether block.prediction is still written as raw float64 for older readers
+MODEL_VERSION    = config('MODEL_VERSION', default='v1')
+PREDICTION_DTYPE = config('PREDICTION_DTYPE', default='float64')
+UPDATE_BLOCKS    = config('UPDATE_BLOCKS', default=True, cast=bool)
 
 # Get currnt date and range of months/years to look at for predicting future
 date = datetime.datetime.today()
@@ -39,80 +33,34 @@ end_month = date.month - 1
 print(start_year, end_year, start_month, end_month)
 
 # SQL query string for sleecting dates
-dates = "AND ("+" OR ".join(["(incident.year = {} AND incident.month > {})".format(year, start_month) if start_year == year else "(incident.year = {} AND incident.month < {})".format(year, end_month) if end_year == year else "incident.year = {}".format(year) for year in range(start_year, end_year+1)])+")\n"
-
-# SQL query
-query = f"""
-SELECT
-    incident.blockid,
-    incident.year,
-    incident.month,
-    incident.dow,
-    incident.hour,
-    SUM(crimetype.severity)/AVG(block.population) AS severity
-FROM incident
-INNER JOIN block ON incident.blockid = block.id
-INNER JOIN crimetype ON incident.crimetypeid = crimetype.id
-    AND block.population > 0
-    {dates}
-GROUP BY
-    incident.blockid,
-    incident.year,
-    incident.month,
-    incident.dow,
-    incident.hour;
-"""
-
-df = pd.read_sql_query(query, DB_URI, coerce_float=False)
-
-# Get number of blockids and relative location
-block_ids = {}
-for ind, blockid in enumerate(df["blockid"].unique()):
-    block_ids[blockid] = ind
-X = np.zeros((len(block_ids), 12*7*24))
-
-# Create prediction
-for i in df.index.values:
-    X[block_ids[df.loc[i,"blockid"]], ((12 * (df.loc[i,"year"] - start_year) + df.loc[i,"month"] - start_month - 1) * 7 + (df.loc[i,"dow"])) * 24 + df.loc[i,"hour"]] = float(df.loc[i,"severity"])
-
-# Put predictions into pandas DataFrame with corresponding block id
-predictions = pd.DataFrame([[x] for x in list(block_ids)], columns=["id"])
-predictions.loc[:, "prediction"] = predictions["id"].apply(lambda x: X[block_ids[x],:].astype(np.float64).tobytes().hex())
-predictions.loc[:, "month"] = end_month
-predictions.loc[:, "year"] = end_year
-predictions.to_csv("predictions.csv", index=False)
-
-# Query SQL
-query_commit_predictions = """
-CREATE TEMPORARY TABLE temp_predictions (
-    id SERIAL PRIMARY KEY,
-    prediction TEXT,
-    month INTEGER,
-    year INTEGER
-);
-
-COPY temp_predictions (id, prediction, month, year) FROM STDIN DELIMITER ',' CSV HEADER;
-
-UPDATE block
-SET 
-    prediction = DECODE(temp_predictions.prediction, 'hex'),
-    month = temp_predictions.month,
-    year = temp_predictions.year 
-FROM temp_predictions
-WHERE block.id = temp_predictions.id;
-
-DROP TABLE temp_predictions;
-"""
-
-# Open saved predictions and send to database using above query
-with open("predictions.csv", "r") as f:
-    print("SENDING TO DB")
-    RAW_CONN = create_engine(DB_URI).raw_connection()
-    cursor = RAW_CONN.cursor()
-    cursor.copy_expert(query_commit_predictions, f)
-    RAW_CONN.commit()
-    RAW_CONN.close()
-os.remove("predictions.csv")
-
-for r in SESSION.execute("SELECT ENCODE(prediction::BYTEA, 'hex'), id FROM block WHERE prediction IS NOT NULL LIMIT 5;").fetchall():
-    print(np.frombuffer(bytes.fromhex(r[0]), dtype=np.float64).reshape((12,7,24)).shape)
+dates = "("+" OR ".join(["(incidentcube.year = {} AND incidentcube.month > {})".format(year, start_month) if start_year == year else "(incidentcube.year = {} AND incidentcube.month < {})".format(year, end_month) if end_year == year else "incidentcube.year = {}".format(year) for year in range(start_year, end_year+1)])+")"
+
+# SQL query, summed from the incident cube instead of scanning incident
+query = severity_query(dates)
+
+df = pd.read_sql_query(query, ENGINE, coerce_float=False)
+
+# Create prediction, one row per blockid and relative location
+blockids, X = severity_tensor(df, start_year, start_month)
+
+# Store predictions under this run's model version, and in block.prediction
+print("SENDING TO DB")
+BASE.metadata.create_all(bind=ENGINE, tables=[Prediction.__table__])
+start = time.perf_counter()
+RAW_CONN = raw_connection(DB_URI)
+count = write_predictions(RAW_CONN, MODEL_VERSION, end_year, end_month, blockids, X, PREDICTION_DTYPE)
+if UPDATE_BLOCKS:
+    update_blocks(RAW_CONN, end_year, end_month, blockids, X)
+RAW_CONN.close()
+print("uploaded {} predictions in {:.2f}s".format(count, time.perf_counter() - start))
+
+RAW_CONN = raw_connection(DB_URI)
+cursor = RAW_CONN.cursor()
+cursor.execute("SELECT id FROM city ORDER BY id;")
+cityids = [row[0] for row in cursor.fetchall()]
+cursor.close()
+for cityid in cityids:
+    ids, predictions = read_predictions(RAW_CONN, cityid, MODEL_VERSION, end_year, end_month)
+    print(cityid, predictions.shape)
+RAW_CONN.close()
+print_report()
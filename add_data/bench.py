@@ -0,0 +1,376 @@
+"""Benchmarks for the data loading helpers.
+
+Run from the add_data folder with the city files in place, e.g.
+    python bench.py blocks 20000
+"""
+
+from shapely import wkb, wkt
+from shapely.geometry import shape
+from shapely.geometry.multipolygon import MultiPolygon
+import numpy as np
+import pandas as pd
+import shapely
+from blockindex import BlockIndex
+from export import FrameWriter
+from geomcache import GeometryCache, cached_shapes
+from ingest import binary_chunks, copy_frames, csv_chunks
+from predcodec import decode_many, encode
+from tensors import _severity_tensor_loop, severity_tensor
+from tiles import ZOOMS, decimals, feature_collection, simplify_shapes
+from transforms import add_time_columns, point_wkt, wkb_hex_points
+from decimal import Decimal
+import io
+import json
+import os
+import sys
+import time
+
+
+def timed(label, func, *args, **kwargs):
+    """Run func once and print how long it took."""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    print("{:<40} {:>10.3f}s".format(label, time.perf_counter() - start))
+    return result
+
+
+def mismatches(old, new):
+    """Count positions where two id arrays differ, treating None/NaN as equal."""
+    old = pd.Series(old, dtype=object)
+    new = pd.Series(new, dtype=object)
+    both_missing = old.isna().values & new.isna().values
+    return int((~both_missing & (old.values != new.values)).sum())
+
+
+def chicago_tracts():
+    """Chicago tract shapes as loaded into the block table."""
+    with open("Chicago_Data/boundaries_tracts.json", "r") as fp:
+        features = json.load(fp)["features"]
+    shapes = []
+    for feature in features:
+        geom = shape(feature["geometry"])
+        if geom.geom_type != "MultiPolygon":
+            geom = MultiPolygon([geom])
+        shapes.append(geom)
+    return list(range(1, len(shapes) + 1)), shapes
+
+
+def bench_blocks(n=20000):
+    """Block assignment: per-point scan vs BlockIndex."""
+    ids, shapes = chicago_tracts()
+    incidents = pd.read_csv("Chicago_Data/crimes.csv", usecols=["Longitude", "Latitude"], nrows=int(n))
+    points = incidents[["Longitude", "Latitude"]].apply(lambda x: "POINT({})".format(" ".join([str(y) for y in x])), axis=1)
+    block_dict = dict(zip(ids, shapes))
+
+    def find_blockid(x):
+        geom = wkt.loads(x)
+        for k in block_dict:
+            if block_dict[k].contains(geom):
+                return k
+        return None
+
+    print("{} incidents, {} blocks".format(len(incidents), len(ids)))
+    old = timed("scan (find_blockid)", lambda: points.apply(find_blockid).values)
+    index = timed("build BlockIndex", BlockIndex, ids, shapes)
+    new = timed("BlockIndex.assign", index.assign, incidents["Longitude"], incidents["Latitude"])
+    print("mismatches:", mismatches(old, new))
+
+
+def bench_transforms(n=200000):
+    """Location and datetime columns: row-wise apply vs vectorized stage."""
+    incidents = pd.read_csv("Chicago_Data/crimes.csv", usecols=["Date", "Longitude", "Latitude"], nrows=int(n))
+    print("{} incidents".format(len(incidents)))
+
+    def old_transform(incidents):
+        incidents.loc[:,"location"] = incidents[["Longitude", "Latitude"]].apply(lambda x: "POINT({})".format(" ".join([str(y) for y in x])), axis=1)
+        incidents.loc[:, "datetime"] = pd.to_datetime(incidents["Date"])
+        incidents.loc[:, "hour"] = incidents["datetime"].apply(lambda x: x.hour)
+        incidents.loc[:, "dow"] = incidents["datetime"].apply(lambda x: x.weekday())
+        incidents.loc[:, "month"] = incidents["datetime"].apply(lambda x: x.month)
+        incidents.loc[:, "year"] = incidents["datetime"].apply(lambda x: x.year)
+        return incidents
+
+    def new_transform(incidents):
+        incidents.loc[:,"location"] = point_wkt(incidents["Longitude"], incidents["Latitude"])
+        return add_time_columns(incidents, "Date", "%m/%d/%Y %I:%M:%S %p")
+
+    old = timed("row-wise apply", old_transform, incidents.copy())
+    new = timed("vectorized", new_transform, incidents.copy())
+    columns = ["datetime", "hour", "dow", "month", "year"]
+    same = (old[columns].astype(str).values == new[columns].astype(str).values).all()
+    same = same and old["location"].dropna().equals(new["location"].dropna())
+    print("identical:", bool(same))
+
+
+def bench_copy(n=200000):
+    """COPY payload encoding: CSV with WKT vs binary with EWKB, client side."""
+    incidents = pd.read_csv("Chicago_Data/crimes.csv", usecols=["Date", "Longitude", "Latitude"], nrows=int(n)).dropna()
+    incidents = add_time_columns(incidents, "Date", "%m/%d/%Y %I:%M:%S %p")
+    for c in ["crimetypeid", "locdescid", "cityid", "blockid"]:
+        incidents.loc[:, c] = 1
+    columns = ["crimetypeid", "locdescid", "cityid", "blockid", "location", "datetime", "hour", "dow", "month", "year"]
+    types = dict(zip(columns, ["int8"] * 4 + ["geometry", "timestamp"] + ["int4"] * 4))
+    print("{} incidents".format(len(incidents)))
+
+    def text():
+        incidents.loc[:, "location"] = point_wkt(incidents["Longitude"], incidents["Latitude"])
+        return b"".join(csv_chunks([incidents], columns))
+
+    def binary():
+        incidents["location"] = shapely.points(incidents["Longitude"].values, incidents["Latitude"].values)
+        return b"".join(binary_chunks([incidents], columns, types))
+
+    print("{} bytes".format(len(timed("csv + WKT", text))))
+    print("{} bytes".format(len(timed("binary + EWKB", binary))))
+    ids, shapes = chicago_tracts()
+    blocks = pd.DataFrame({"cityid": 1, "shape": shapes, "population": 0})
+    block_types = {"cityid": "int8", "shape": "geometry", "population": "int4"}
+    timed("blocks csv + WKT", lambda: b"".join(csv_chunks([blocks.assign(shape=shapely.to_wkt(shapes, rounding_precision=-1))], list(block_types))))
+    timed("blocks binary + EWKB", lambda: b"".join(binary_chunks([blocks], list(block_types), block_types)))
+
+
+def bench_tensor(n=200000):
+    """Severity array of allblocks.py: per-row .loc loop vs severity_tensor."""
+    rng = np.random.default_rng(0)
+    start_year, start_month = 2018, 3
+    month = rng.integers(0, 12, int(n)) + start_month
+    df = pd.DataFrame({
+        "blockid": rng.integers(1, 2000, int(n)),
+        "year": start_year + (month > 12),
+        "month": (month - 1) % 12 + 1,
+        "dow": rng.integers(0, 7, int(n)),
+        "hour": rng.integers(0, 24, int(n)),
+        "severity": [Decimal(str(x)) for x in rng.uniform(0, 5, int(n)).round(6)],
+    }).drop_duplicates(["blockid", "year", "month", "dow", "hour"]).reset_index(drop=True)
+    print("{} grouped rows".format(len(df)))
+    old_ids, old = timed("per-row loop", _severity_tensor_loop, df, start_year, start_month)
+    new_ids, new = timed("severity_tensor", severity_tensor, df, start_year, start_month)
+    print("identical:", list(new_ids) == old_ids and np.array_equal(old, new))
+
+
+def bench_upload(n=2000):
+    """Prediction upload of allblocks.py: hex CSV file + DECODE vs binary COPY
+        of the raw bytes. Only fills a temporary table, block is not touched.
+        Needs DB_URI to point at a database."""
+    from decouple import config
+    from db import raw_connection
+    conn = raw_connection(config('DB_URI'))
+    X = np.random.default_rng(0).uniform(0, 1, (int(n), 12*7*24))
+    ids = np.arange(1, int(n) + 1)
+    create = "CREATE TEMPORARY TABLE bench_predictions (id BIGINT PRIMARY KEY, prediction BYTEA, month INTEGER, year INTEGER);"
+
+    def hex_csv():
+        cursor = conn.cursor()
+        cursor.execute(create.replace("prediction BYTEA", "prediction TEXT"))
+        predictions = pd.DataFrame({"id": ids, "prediction": [x.tobytes().hex() for x in X], "month": 1, "year": 2019})
+        predictions.to_csv("bench_predictions.csv", index=False)
+        with open("bench_predictions.csv", "r") as f:
+            cursor.copy_expert("COPY bench_predictions (id, prediction, month, year) FROM STDIN DELIMITER ',' CSV HEADER;", f)
+        cursor.execute("SELECT SUM(LENGTH(DECODE(prediction, 'hex'))) FROM bench_predictions;")
+        cursor.execute("DROP TABLE bench_predictions;")
+        conn.commit()
+        os.remove("bench_predictions.csv")
+
+    def binary():
+        cursor = conn.cursor()
+        cursor.execute(create)
+        predictions = pd.DataFrame({"id": ids, "prediction": [x.tobytes() for x in X], "month": 1, "year": 2019})
+        copy_frames(conn, "bench_predictions", ["id", "prediction", "month", "year"], [predictions], types={"id": "int8", "prediction": "bytea", "month": "int4", "year": "int4"})
+        cursor.execute("DROP TABLE bench_predictions;")
+        conn.commit()
+
+    print("{} predictions".format(len(X)))
+    timed("hex CSV file + DECODE", hex_csv)
+    timed("binary COPY", binary)
+    conn.close()
+
+
+def bench_codec(n=2000, source="synthetic"):
+    """Prediction codec: size, max error and decode time per dtype. source
+        "db" uses the block.prediction rows of DB_URI, "synthetic" a sparse
+        array shaped like allblocks.py output."""
+    if source == "db":
+        from decouple import config
+        from db import raw_connection
+        conn = raw_connection(config('DB_URI'))
+        cursor = conn.cursor()
+        cursor.execute("SELECT prediction FROM block WHERE prediction IS NOT NULL LIMIT %s;", (int(n),))
+        X = decode_many([r[0] for r in cursor.fetchall()])
+        conn.close()
+    else:
+        rng = np.random.default_rng(0)
+        X = rng.poisson(0.08, (int(n), 12, 7, 24)) * rng.uniform(0.5, 3, (int(n), 1, 1, 1)) / rng.integers(500, 5000, (int(n), 1, 1, 1))
+    print("{} predictions, {:.1%} zero, raw {} bytes".format(len(X), (X == 0).mean(), X.nbytes))
+    for dtype in ["float64", "float32", "float16", "uint16", "uint8"]:
+        for sparse in [False, None]:
+            blobs = [encode(x, dtype, sparse) for x in X]
+            start = time.perf_counter()
+            out = decode_many(blobs, X.shape[1:])
+            elapsed = time.perf_counter() - start
+            print("{:<8} {:<7} {:>10} bytes {:>6.1%}   max error {:.2e}   decode {:.3f}s".format(
+                dtype, "auto" if sparse is None else "dense", sum(len(b) for b in blobs), sum(len(b) for b in blobs) / X.nbytes, np.abs(out - X).max(), elapsed))
+
+
+def bench_points(n=1000000):
+    """Export coordinates of getdata.py: per-row geomet parsing vs
+        wkb_hex_points over hex WKB as COPY returns it."""
+    from geomet import wkb as geomet_wkb, wkt as geomet_wkt
+    rng = np.random.default_rng(0)
+    locations = pd.Series(shapely.to_wkb(shapely.points(rng.uniform(-88, -87, int(n)), rng.uniform(41, 42, int(n))), hex=True))
+    print("{} locations".format(len(locations)))
+
+    def per_row():
+        data = pd.DataFrame({"location": locations.astype(object)})
+        data.loc[:,"location"] = data.loc[:,"location"].apply(lambda x: [float(y) for y in geomet_wkt.dumps(geomet_wkb.loads(bytes.fromhex(x))).replace("(", "").replace(")", "").split(" ")[1:]])
+        data.loc[:,"latitude"] = data.loc[:,"location"].apply(lambda x: x[0])
+        data.loc[:,"longitude"] = data.loc[:,"location"].apply(lambda x: x[1])
+        return data[["latitude", "longitude"]].values.astype(float)
+
+    old = timed("geomet per row", per_row)
+    new = timed("wkb_hex_points", wkb_hex_points, locations)
+    print("identical:", np.array_equal(old, new))
+
+
+def bench_export(n=1000000):
+    """Export encodings of getdata.py: size, encode and parse time of CSV,
+        NDJSON, Arrow IPC and Parquet for a synthetic export frame. Arrow
+        and Parquet need pyarrow."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    n = int(n)
+    rng = np.random.default_rng(0)
+    categories = ["THEFT", "BATTERY", "CRIMINAL DAMAGE", "NARCOTICS", "ASSAULT", "OTHER OFFENSE", "BURGLARY", "ROBBERY", "MOTOR VEHICLE THEFT", "HOMICIDE"]
+    keys = [("INDOOR", "RESIDENTIAL", "APARTMENT"), ("INDOOR", "RESIDENTIAL", "HOUSE"), ("OUTDOOR", "STREET", "STREET"), ("OUTDOOR", "STREET", "ALLEY"), ("INDOOR", "COMMERCIAL", "STORE")]
+    key = rng.integers(0, len(keys), n)
+    data = pd.DataFrame({
+        "city": "Chicago", "state": "IL", "country": "USA",
+        "datetime": (pd.Timestamp("2015-01-01") + pd.to_timedelta(rng.integers(0, 4 * 365 * 86400, n), unit="s")).strftime("%Y-%m-%d %H:%M:%S"),
+        "category": np.array(categories)[rng.integers(0, len(categories), n)],
+        "location_key1": [keys[k][0] for k in key], "location_key2": [keys[k][1] for k in key], "location_key3": [keys[k][2] for k in key],
+        "latitude": rng.uniform(41.6, 42.1, n), "longitude": rng.uniform(-87.9, -87.5, n),
+    })
+    readers = {
+        "csv": lambda b: pd.read_csv(io.BytesIO(b)),
+        "ndjson": lambda b: pd.read_json(io.BytesIO(b), lines=True),
+        "arrow": lambda b: pa.ipc.open_stream(b).read_all(),
+        "parquet": lambda b: pq.read_table(io.BytesIO(b)),
+    }
+    print("{} rows".format(n))
+    print("{:<24} {:>12} {:>10} {:>10}".format("format", "bytes", "encode", "parse"))
+    for fmt, options in [("csv", {}), ("ndjson", {}), ("arrow", {}), ("arrow", {"coordinate_dtype": "float32"}),
+                         ("parquet", {"compression": "snappy"}), ("parquet", {"compression": "zstd"}), ("parquet", {"compression": "zstd", "coordinate_dtype": "float32"})]:
+        out = io.StringIO() if fmt in ("csv", "ndjson") else io.BytesIO()
+        start = time.perf_counter()
+        writer = FrameWriter(out, fmt, **options)
+        for offset in range(0, n, 50000):
+            writer.write(data.iloc[offset:offset + 50000])
+        writer.close()
+        encode = time.perf_counter() - start
+        body = out.getvalue().encode() if fmt in ("csv", "ndjson") else out.getvalue()
+        start = time.perf_counter()
+        readers[fmt](body)
+        parse = time.perf_counter() - start
+        label = " ".join([fmt] + [str(v) for v in options.values()])
+        print("{:<24} {:>12} {:>9.3f}s {:>9.3f}s".format(label, len(body), encode, parse))
+
+
+def bench_engines(n=200000):
+    """Block assignment: BlockIndex in Python vs ST_Contains in PostGIS.
+        Needs DB_URI to point at a database with the blocks loaded."""
+    from decouple import config
+    from db import raw_connection
+    conn = raw_connection(config('DB_URI'))
+    incidents = pd.read_csv("Chicago_Data/crimes.csv", usecols=["Longitude", "Latitude"], nrows=int(n)).dropna()
+    locations = pd.DataFrame({"location": point_wkt(incidents["Longitude"], incidents["Latitude"])})
+    print("{} incidents".format(len(incidents)))
+
+    def python_engine():
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, ST_AsBinary(shape) FROM block ORDER BY id;")
+        index = BlockIndex.from_wkb(cursor.fetchall())
+        cursor.close()
+        return index.assign(incidents["Longitude"], incidents["Latitude"])
+
+    def postgis_engine():
+        cursor = conn.cursor()
+        cursor.execute("CREATE TEMPORARY TABLE bench_points (n SERIAL, location GEOMETRY);")
+        conn.commit()
+        copy_frames(conn, "bench_points", ["location"], [locations])
+        cursor.execute("""
+            SELECT b.id FROM bench_points s
+            LEFT JOIN LATERAL (
+                SELECT block.id FROM block
+                WHERE ST_Contains(block.shape, s.location)
+                ORDER BY block.id LIMIT 1
+            ) b ON TRUE
+            ORDER BY s.n;
+        """)
+        ids = [r[0] for r in cursor.fetchall()]
+        cursor.execute("DROP TABLE bench_points;")
+        cursor.close()
+        conn.commit()
+        return ids
+
+    old = timed("python (download blocks + assign)", python_engine)
+    new = timed("postgis (COPY + ST_Contains)", postgis_engine)
+    print("mismatches:", mismatches(old, new))
+    conn.close()
+
+
+def bench_geomcache(path="geometry_cache/bench_block.geoc"):
+    """Loading block shapes: fetch + parse from the database vs the local cache.
+        Needs DB_URI to point at a database with the blocks loaded."""
+    from decouple import config
+    from db import raw_connection
+    conn = raw_connection(config('DB_URI'))
+
+    def fetch():
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, ST_AsBinary(shape) FROM block ORDER BY id;")
+        rows = cursor.fetchall()
+        cursor.close()
+        return [wkb.loads(bytes(r[1])) for r in rows]
+
+    old = timed("fetch + wkb.loads", fetch)
+    timed("cached_shapes (first, writes file)", cached_shapes, conn, "block", path)
+    timed("cached_shapes (stamp + open)", cached_shapes, conn, "block", path)
+    timed("cached_shapes (verify checksum + open)", cached_shapes, conn, "block", path, verify=True)
+    new = timed("GeometryCache + geometries", lambda: GeometryCache(path).geometries())
+    print("identical:", all(a.equals(b) for a, b in zip(old, new)) and len(old) == len(new))
+    conn.close()
+
+
+def bench_tiles():
+    """Map GeoJSON of the Chicago tracts: full resolution vs simplified and
+        quantized for each zoom of tiles.ZOOMS."""
+    ids, shapes = chicago_tracts()
+    full = timed("full GeoJSON", feature_collection, ids, shapes, {}, 15)
+    print("{:<8} {:>10} {:>10} {:>12}".format("zoom", "bytes", "coords", "area ratio"))
+    print("{:<8} {:>10} {:>10} {:>12}".format("full", len(full), int(shapely.get_num_coordinates(shapes).sum()), 1))
+    area = shapely.area(shapely.union_all(shapes))
+    for zoom in ZOOMS:
+        simplified = timed("simplify z{}".format(zoom), simplify_shapes, shapes, zoom)
+        text = feature_collection(ids, simplified, {}, decimals(zoom))
+        print("{:<8} {:>10} {:>10} {:>12.5f}".format(zoom, len(text), int(shapely.get_num_coordinates(simplified).sum()), shapely.area(shapely.union_all(simplified)) / area))
+
+
+BENCHMARKS = {
+    "blocks": bench_blocks,
+    "transforms": bench_transforms,
+    "codec": bench_codec,
+    "copy": bench_copy,
+    "engines": bench_engines,
+    "points": bench_points,
+    "export": bench_export,
+    "tensor": bench_tensor,
+    "upload": bench_upload,
+    "geomcache": bench_geomcache,
+    "tiles": bench_tiles,
+}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print("usage: python bench.py [{}] [args...]".format("|".join(BENCHMARKS)))
+        sys.exit(1)
+    BENCHMARKS[sys.argv[1]](*sys.argv[2:])
@@ -0,0 +1,70 @@
+"""Spatial index for assigning incident points to city blocks."""
+
+import numpy as np
+import shapely
+from shapely import wkb
+
+
+class BlockIndex:
+    """STRtree over prepared block shapes. Assigns many points in one call.
+
+    Blocks are kept in the order they are given, so when a point falls inside
+    more than one block the first one wins, same as scanning `block_dict`.
+    """
+
+    def __init__(self, ids, shapes):
+        self.ids = np.asarray(ids, dtype=object)
+        self.shapes = np.asarray(shapes, dtype=object)
+        shapely.prepare(self.shapes)
+        self.tree = shapely.STRtree(self.shapes)
+
+    @classmethod
+    def from_wkb(cls, rows):
+        """Build index from (id, wkb bytes) pairs."""
+        ids = []
+        shapes = []
+        for blockid, data in rows:
+            ids.append(blockid)
+            shapes.append(wkb.loads(bytes(data)))
+        return cls(ids, shapes)
+
+    @classmethod
+    def from_blocks(cls, blocks):
+        """Build index from `Blocks` rows as returned by the ORM."""
+        return cls.from_wkb((b.id, b.shape.data.tobytes()) for b in blocks)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def assign(self, x, y):
+        """Return block id per (x, y) point, None where no block contains it."""
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        result = np.full(len(x), None, dtype=object)
+        valid = ~(np.isnan(x) | np.isnan(y))
+        points = shapely.points(x[valid], y[valid])
+        pt_idx, blk_idx = self.tree.query(points, predicate="within")
+        if len(pt_idx) == 0:
+            return result
+        # keep the first block (lowest position) for every point
+        order = np.lexsort((blk_idx, pt_idx))
+        pt_idx = pt_idx[order]
+        blk_idx = blk_idx[order]
+        first = np.ones(len(pt_idx), dtype=bool)
+        first[1:] = pt_idx[1:] != pt_idx[:-1]
+        result[np.flatnonzero(valid)[pt_idx[first]]] = self.ids[blk_idx[first]]
+        return result
+
+    def assign_wkt(self, points):
+        """Return block id per "POINT(x y)" string, like `find_blockid`."""
+        xy = parse_points(points)
+        return self.assign(xy[:, 0], xy[:, 1])
+
+
+def parse_points(points):
+    """Parse "POINT(x y)" strings into an (n, 2) float array."""
+    geoms = shapely.from_wkt(np.asarray(points, dtype=object), on_invalid="ignore")
+    xy = np.full((len(geoms), 2), np.nan)
+    ok = ~(shapely.is_missing(geoms) | shapely.is_empty(geoms))
+    xy[ok] = shapely.get_coordinates(geoms[ok])
+    return xy
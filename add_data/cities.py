@@ -0,0 +1,212 @@
+"""City adapters: what differs between the cities we load, and a runner that
+ingests several cities at once."""
+
+from shapely.geometry import shape
+from shapely.geometry.multipolygon import MultiPolygon
+import shapefile
+import pandas as pd
+from blockindex import parse_points
+from population import lookup_population, tract_populations
+from reproject import projected_shapes
+from transforms import paren_point_wkt, point_wkt
+from abc import ABC, abstractmethod
+import multiprocessing
+import json
+import os
+
+
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+
+CITIES = {}
+
+ZIPCODES_CHICAGO = [60007, 60018, 60068, 60106, 60131, 60176, 60601, 60602, 60603, 60604, 60605, 60606, 60607, 60608, 60609, 60610, 60611, 60612, 60613, 60614, 60615, 60616, 60617, 60618, 60619, 60620, 60621, 60622, 60623, 60624, 60625, 60626, 60628, 60629, 60630, 60631, 60632, 60633, 60634, 60636, 60637, 60638, 60639, 60640, 60641, 60642, 60643, 60644, 60645, 60646, 60647, 60649, 60651, 60652, 60653, 60654, 60655, 60656, 60657, 60659, 60660, 60661, 60706, 60707, 60714, 60804, 60827]
+ZIPCODES_LA = [90895,91001,91006,91007,91011,91010,91016,91020,91017,93510,91023,91024,91030,91040,91043,91042,91101,91103,91105,93534,91104,93532,91107,93536,91106,93535,91108,93543,93544,91123,93551,93550,93553,93552,91182,93563,93590,91189,91202,91201,93591,91204,91203,91206,91205,91208,91207,91210,91214,91302,91301,91304,91303,91306,91307,91310,92397,91311,91316,91321,91325,91324,91326,91331,91330,91335,91340,91343,91342,91345,91344,91350,91346,91352,91351,91354,91356,91355,91357,91361,91364,91367,91365,91381,91383,91384,91387,91390,91402,91401,91404,91403,91406,91405,91411,91423,91436,91495,91501,91502,91505,91504,91506,91602,91601,91604,91606,91605,91608,91607,91614,91706,91702,91711,91722,91724,91723,91732,91731,91733,91735,91740,91741,91745,91744,91747,91746,91748,90002,90001,91750,91755,90004,90003,91754,90006,90005,90008,91759,90007,90010,90012,91765,90011,90014,91767,91766,90013,90016,90015,91768,90018,91770,90017,90020,91773,91772,90019,90022,91776,90021,91775,91780,90024,91778,90023,90026,90025,90028,90027,91790,90029,91789,90032,91792,91791,90031,90034,91793,90033,90036,90035,90038,91801,90037,90040,91803,90039,90042,90041,90044,90043,90046,90045,90048,90047,90049,90052,90056,90058,90057,90060,90059,90062,90061,90064,90063,90066,90065,90068,90067,90069,90071,90074,90077,91008,90084,90089,90095,90094,90096,90201,90189,90211,90210,90212,90221,90220,90222,90230,90232,90241,90240,90245,90242,90248,90247,90250,90249,90254,90260,90255,90262,90264,90263,90266,90265,90270,90274,90272,90277,90275,90280,90278,90291,90290,90293,90292,90295,90301,90296,90303,90302,90305,90304,90402,90401,90404,90403,90406,93243,90405,90501,90503,90502,90505,90504,90508,90601,90603,90602,90605,90604,90606,90631,90639,90638,90650,90640,90660,90670,90702,90701,90704,90703,90706,90710,90713,90712,90715,90717,90716,90731,90723,90733,90732,90745,90744,90747,90746,90755,90803,90802,90805,90804,90807,90806,90808,90813,90810,90815,90814,90840]
+
+
+def register_city(adapter):
+    """Add a city adapter to the registry under its name."""
+    CITIES[adapter.name] = adapter
+    return adapter
+
+
+def multipolygon(geom):
+    """A Polygon/MultiPolygon, shapely or GeoJSON, always as a MultiPolygon."""
+    if isinstance(geom, dict):
+        geom = shape(geom)
+    if geom.geom_type != "MultiPolygon":
+        geom = MultiPolygon([geom])
+    return geom
+
+
+class CityAdapter(ABC):
+    """Declares one city's source files and columns. Incidents, zipcodes and
+        the city row are handled from these attributes alone; subclasses only
+        override blocks() since every city publishes tracts differently."""
+    name           = None
+    city           = None
+    state          = None
+    country        = None
+    location       = None
+    folder         = None
+    crimes_file    = "crimes.csv"
+    crime_column   = None
+    locdesc_column = None
+    date_column    = None
+    date_format    = None
+    hour_column    = None
+    # Either two coordinate columns (x, y) or one "(x, y)" string column
+    point_columns  = None
+    point_column   = None
+    zipcodes_file  = "zipcodes.json"
+    zipcodes       = []
+
+    def path(self, filename):
+        """Path of one of the city's source files."""
+        return os.path.join(DATA_DIR, self.folder, filename)
+
+    def city_row(self):
+        """Row for the city table."""
+        return [self.city, self.state, self.country, self.location]
+
+    @abstractmethod
+    def blocks(self):
+        """DataFrame of block shapes, as MultiPolygons, and population."""
+
+    def zipcode_shapes(self):
+        """DataFrame of zipcode and MultiPolygon shape for the city's zipcodes."""
+        with open(self.path(self.zipcodes_file), "r") as fp:
+            features = json.load(fp)["features"]
+        zipcodes = set(str(x) for x in self.zipcodes)
+        rows = []
+        for zc in features:
+            if zc["properties"]["ZCTA5CE10"] in zipcodes:
+                rows.append([zc["properties"]["ZCTA5CE10"], multipolygon(zc["geometry"])])
+        return pd.DataFrame(rows, columns=["zipcode", "shape"])
+
+    def points(self, incidents):
+        """Drop incidents without a location and add the location WKT column.
+            Returns the incidents and their x and y coordinates."""
+        if self.point_columns is not None:
+            x, y = self.point_columns
+            incidents.loc[:, "location"] = point_wkt(incidents[x], incidents[y])
+            return incidents, incidents[x].values, incidents[y].values
+        locations = incidents[self.point_column]
+        incidents = incidents.loc[locations.notna() & (locations.astype(str) != "(0, 0)")].copy()
+        incidents.loc[:, "location"] = paren_point_wkt(incidents[self.point_column])
+        xy = parse_points(incidents["location"])
+        return incidents, xy[:, 0], xy[:, 1]
+
+
+class Chicago(CityAdapter):
+    """Chicago census tracts from GeoJSON, populations summed from census
+        blocks."""
+    name           = "chicago"
+    city           = "CHICAGO"
+    state          = "ILLINOIS"
+    country        = "UNITED STATES OF AMERICA"
+    location       = "POINT(41.8781 -87.6298)"
+    folder         = "Chicago_Data"
+    crime_column   = "Primary Type"
+    locdesc_column = "Location Description"
+    date_column    = "Date"
+    date_format    = "%m/%d/%Y %I:%M:%S %p"
+    point_columns  = ("Longitude", "Latitude")
+    zipcodes       = ZIPCODES_CHICAGO
+
+    def blocks(self):
+        with open(self.path("boundaries.json"), "r") as fp:
+            boundaries = json.load(fp)["features"]
+        with open(self.path("boundaries_tracts.json"), "r") as fp:
+            boundaries_tracts = json.load(fp)["features"]
+        popu = tract_populations(boundaries, pd.read_csv(self.path("populations.csv")))
+        rows = []
+        for tract in boundaries_tracts:
+            rows.append([multipolygon(tract["geometry"]), popu[tract["properties"]["tractce10"]]])
+        return pd.DataFrame(rows, columns=["shape", "population"])
+
+
+class LosAngeles(CityAdapter):
+    """Los Angeles census tracts from a State Plane shapefile, populations
+        looked up by OBJECTID."""
+    name           = "la"
+    city           = "LOS ANGELES"
+    state          = "CALIFORNIA"
+    country        = "UNITED STATES OF AMERICA"
+    location       = "POINT(34.0522 -118.2437)"
+    folder         = "LA_Data"
+    crime_column   = "Crime Code Description"
+    locdesc_column = "Premise Description"
+    date_column    = "Date Occurred"
+    date_format    = "%m/%d/%Y"
+    hour_column    = "Time Occurred"
+    point_column   = "Location "
+    zipcodes       = ZIPCODES_LA
+
+    def blocks(self):
+        src = shapefile.Reader(self.path("tracts.shp"))
+        shapes = projected_shapes(self.path("tracts.shp"), "ESRI:102645", "EPSG:4326", lambda: [shape(s.__geo_interface__) for s in src.shapes()])
+        pops = pd.read_csv(self.path("population.csv"))
+        rows = []
+        for geom, rec in zip(shapes, src.records()):
+            rows.append([multipolygon(geom), rec[0]])
+        blocks = pd.DataFrame(rows, columns=["shape", "population"])
+        blocks.loc[:, "population"] = lookup_population(blocks["population"], pops, "OBJECTID", "POP", "tracts").values
+        blocks = blocks.dropna()
+        blocks.loc[:, "population"] = blocks.loc[:, "population"].astype(int)
+        return blocks
+
+
+register_city(Chicago())
+register_city(LosAngeles())
+
+
+def run_cities(names, ingest_city, workers=1):
+    """Run ingest_city(name) for every name, up to `workers` cities at once in
+        forked processes. Callers must not hold open DB connections when
+        workers > 1, since forked children would share them. The statement
+        timings of each child are added to db.STATS of this process."""
+    if workers <= 1:
+        for name in names:
+            ingest_city(name)
+        return
+    ctx = multiprocessing.get_context("fork")
+    running = []
+    failed = []
+    for name in names:
+        if len(running) >= workers:
+            failed += _wait_first(running)
+        stats, child_stats = ctx.Pipe(duplex=False)
+        proc = ctx.Process(target=_run_city, args=(ingest_city, name, child_stats), name=name)
+        proc.start()
+        child_stats.close()
+        running.append((proc, stats))
+    while running:
+        failed += _wait_first(running)
+    if failed:
+        raise RuntimeError("city ingest failed: {}".format(", ".join(failed)))
+
+
+def _run_city(ingest_city, name, stats):
+    """Body of a city process: ingest the city, then send the statements it
+        ran back to the parent, also when it failed."""
+    from db import STATS
+    STATS.clear()
+    try:
+        ingest_city(name)
+    finally:
+        stats.send(STATS)
+        stats.close()
+
+
+def _wait_first(running):
+    """Wait for the oldest running city process, merge its statement timings
+        and return its name if it failed."""
+    from db import merge_stats
+    proc, stats = running.pop(0)
+    try:
+        merge_stats(stats.recv())
+    except EOFError:
+        pass
+    stats.close()
+    proc.join()
+    return [proc.name] if proc.exitcode != 0 else []
@@ -0,0 +1,72 @@
+"""Incident counts rolled up per block, hour and crime type.
+
+incidentcube has one row per (cityid, blockid, year, month, dow, hour,
+crimetypeid) with the number of incidents in it. Severity sums are
+SUM(count * crimetype.severity) over it, so the same cube serves any
+weighting of crime types.
+"""
+
+
+CUBE_KEYS = ["cityid", "blockid", "year", "month", "dow", "hour", "crimetypeid"]
+
+
+def refresh_cube(raw_conn, cityid, since=None):
+    """Recount the cube rows of every month of a city that has incidents at
+        or after since, or of all its months when since is None or the city
+        has no cube rows yet. Months without new incidents are left alone.
+        Not committed."""
+    keys = ", ".join(CUBE_KEYS)
+    cursor = raw_conn.cursor()
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM incidentcube WHERE cityid = %s);", (cityid,))
+    if not cursor.fetchone()[0]:
+        since = None
+    cursor.execute("""
+        CREATE TEMPORARY TABLE cube_months AS
+        SELECT DISTINCT year, month FROM incident
+        WHERE cityid = %(cityid)s AND (%(since)s IS NULL OR datetime >= %(since)s);
+
+        DELETE FROM incidentcube c USING cube_months m
+        WHERE c.cityid = %(cityid)s AND c.year = m.year AND c.month = m.month;
+
+        INSERT INTO incidentcube ({keys}, count)
+        SELECT {i_keys}, COUNT(*) FROM incident i
+        INNER JOIN cube_months m ON i.year = m.year AND i.month = m.month
+        WHERE i.cityid = %(cityid)s
+        GROUP BY {i_keys};
+
+        DROP TABLE cube_months;
+    """.format(keys=keys, i_keys=", ".join("i." + k for k in CUBE_KEYS)), {"cityid": cityid, "since": since})
+    cursor.close()
+
+
+def severity_query(where="TRUE", weight="crimetype.severity", by=("blockid", "year", "month", "dow", "hour")):
+    """SQL of SUM(weight)/AVG(block.population) per `by` columns of the cube,
+        for blocks with people in them. where may use incidentcube, block and
+        crimetype columns."""
+    by = ", ".join("incidentcube." + c for c in by)
+    return """
+        SELECT
+            {by},
+            SUM(incidentcube.count * {weight})/AVG(block.population) AS severity
+        FROM incidentcube
+        INNER JOIN block ON incidentcube.blockid = block.id
+        INNER JOIN crimetype ON incidentcube.crimetypeid = crimetype.id
+            AND block.population > 0
+        WHERE {where}
+        GROUP BY {by}
+    """.format(by=by, weight=weight, where=where)
+
+
+def normalized_severity_query(where="TRUE", weight="crimetype.severity", by=("blockid", "year", "month", "dow", "hour")):
+    """severity_query of the rows matching where, divided by the largest
+        severity of any `by` group in the whole cube."""
+    cols = ", ".join("block_incidents." + c for c in by)
+    return """
+        WITH
+            max_severity AS (
+                SELECT MAX(severity) AS severity FROM ({all}) AS categories
+            ),
+            block_incidents AS ({rows})
+        SELECT {cols}, block_incidents.severity/max_severity.severity AS severity
+        FROM block_incidents, max_severity
+    """.format(all=severity_query("TRUE", weight, by), rows=severity_query(where, weight, by), cols=cols)
@@ -0,0 +1,189 @@
+"""Process-wide pooled database access with per-statement timing.
+
+Every script gets its engine from engine(), which is created once per
+database URI and process (worker processes get their own after a fork).
+All DBAPI cursors of it are TimedCursors, so statements run through
+sessions, raw connections and COPY alike are counted, timed and added to
+STATS, and any statement slower than DB_SLOW_SECONDS is printed to stderr
+when it finishes.
+"""
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+from contextlib import contextmanager
+from decouple import config
+import psycopg2.extensions
+import os
+import re
+import sys
+import threading
+import time
+
+
+DB_POOL_SIZE    = config('DB_POOL_SIZE', default=5, cast=int)
+DB_MAX_OVERFLOW = config('DB_MAX_OVERFLOW', default=5, cast=int)
+DB_SLOW_SECONDS = config('DB_SLOW_SECONDS', default=1.0, cast=float)
+
+# statement label -> [calls, seconds, rows]
+STATS = {}
+_LOCK = threading.Lock()
+_ENGINES = {}
+_UNPOOLED = {}
+_SESSIONS = {}
+
+
+def statement_label(query):
+    """Short label of a statement for STATS: its first 80 characters with
+        whitespace collapsed."""
+    if isinstance(query, bytes):
+        query = query.decode(errors="replace")
+    return re.sub(r"\s+", " ", str(query)).strip()[:80]
+
+
+def record(query, seconds, rows):
+    """Add one run of a statement to STATS, printing it when slow."""
+    label = statement_label(query)
+    with _LOCK:
+        stats = STATS.setdefault(label, [0, 0.0, 0])
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] += max(rows, 0)
+    if seconds >= DB_SLOW_SECONDS:
+        print("\tslow statement {:.3f}s, {} rows: {}".format(seconds, rows, label), file=sys.stderr)
+
+
+def merge_stats(stats):
+    """Add the STATS of another process, e.g. a forked worker, to STATS."""
+    with _LOCK:
+        for label, (calls, seconds, rows) in stats.items():
+            totals = STATS.setdefault(label, [0, 0.0, 0])
+            totals[0] += calls
+            totals[1] += seconds
+            totals[2] += rows
+
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """psycopg2 cursor that records the time and row count of each
+        execute and COPY."""
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            record(query, time.perf_counter() - start, self.rowcount)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            record(query, time.perf_counter() - start, self.rowcount)
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            record(sql, time.perf_counter() - start, self.rowcount)
+
+
+def engine(db_uri=None):
+    """The pooled engine of db_uri (DB_URI by default) in this process.
+        The pool keeps DB_POOL_SIZE connections open and opens at most
+        DB_MAX_OVERFLOW more under load."""
+    db_uri = db_uri or config('DB_URI')
+    key = (db_uri, os.getpid())
+    with _LOCK:
+        if key not in _ENGINES:
+            _ENGINES[key] = create_engine(db_uri, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                                          pool_pre_ping=True, connect_args={"cursor_factory": TimedCursor})
+        return _ENGINES[key]
+
+
+def raw_connection(db_uri=None):
+    """DBAPI connection from the pool, e.g. for COPY. close() hands it
+        back to the pool instead of disconnecting."""
+    return engine(db_uri).raw_connection()
+
+
+def unpooled_connection(db_uri=None, autocommit=False):
+    """New DBAPI connection outside the pool, for connections that change
+        session state such as autocommit or live as long as a worker.
+        close() disconnects. The NullPool engines behind them are kept like
+        those of engine(), one per database and isolation level."""
+    db_uri = db_uri or config('DB_URI')
+    isolation_level = "AUTOCOMMIT" if autocommit else "READ COMMITTED"
+    key = (db_uri, isolation_level, os.getpid())
+    with _LOCK:
+        if key not in _UNPOOLED:
+            _UNPOOLED[key] = create_engine(db_uri, poolclass=NullPool, isolation_level=isolation_level,
+                                           connect_args={"cursor_factory": TimedCursor})
+        bind = _UNPOOLED[key]
+    return bind.raw_connection()
+
+
+@contextmanager
+def connection(db_uri=None):
+    """Pooled DBAPI connection committed when the block succeeds, rolled
+        back when it raises, and returned to the pool either way."""
+    raw_conn = raw_connection(db_uri)
+    try:
+        yield raw_conn
+        raw_conn.commit()
+    except:
+        raw_conn.rollback()
+        raise
+    finally:
+        raw_conn.close()
+
+
+@contextmanager
+def session_scope(db_uri=None):
+    """Provide a transactional scope around a series of operations."""
+    db_uri = db_uri or config('DB_URI')
+    key = (db_uri, os.getpid())
+    bind = engine(db_uri)
+    with _LOCK:
+        if key not in _SESSIONS:
+            _SESSIONS[key] = sessionmaker(bind=bind)
+    session = _SESSIONS[key]()
+    try:
+        yield session
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def copy_in(raw_conn, table, columns, f):
+    """COPY a CSV file object with a header into columns of table and
+        commit. Returns the number of rows."""
+    cursor = raw_conn.cursor()
+    cursor.copy_expert("COPY {}({}) FROM STDIN DELIMITER ',' CSV HEADER;".format(table, ",".join(columns)), f)
+    rows = cursor.rowcount
+    cursor.close()
+    raw_conn.commit()
+    return rows
+
+
+def copy_out(raw_conn, query, f):
+    """Write the result of a SELECT query to a file object as CSV with a
+        header. Returns the number of rows."""
+    cursor = raw_conn.cursor()
+    cursor.copy_expert("COPY ({}) TO STDOUT WITH DELIMITER ',' CSV HEADER;".format(query.strip().rstrip(";")), f)
+    rows = cursor.rowcount
+    cursor.close()
+    return rows
+
+
+def print_report(limit=20):
+    """Print the statements that took the most time in total."""
+    with _LOCK:
+        rows = sorted(STATS.items(), key=lambda x: -x[1][1])[:limit]
+    print("{:>8} {:>10} {:>10}  {}".format("calls", "seconds", "rows", "statement"))
+    for label, (calls, seconds, nrows) in rows:
+        print("{:>8} {:>10.3f} {:>10}  {}".format(calls, seconds, nrows, label))
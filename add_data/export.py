@@ -0,0 +1,154 @@
+"""Stream COPY ... TO STDOUT results through pandas in bounded chunks, and
+write export frames as CSV, NDJSON, Arrow IPC stream or Parquet."""
+
+from queries import COLUMNS
+from transforms import wkb_hex_points
+import numpy as np
+import pandas as pd
+import io
+
+
+# Output formats, and which of them are written to a text stream
+EXPORT_FORMATS = ["csv", "ndjson", "arrow", "parquet"]
+TEXT_FORMATS = ["csv", "ndjson"]
+# Repeating string columns of an export, dictionary encoded in columnar formats
+CATEGORICAL_COLUMNS = ["city", "state", "country", "category", "location_key1", "location_key2", "location_key3"]
+COORDINATE_COLUMNS = ["latitude", "longitude"]
+# Columns of an export after format_locations
+EXPORT_COLUMNS = [c for c in COLUMNS if c != "location"] + COORDINATE_COLUMNS
+
+
+def format_locations(data):
+    """Replace the hex WKB location column with latitude and longitude."""
+    xy = wkb_hex_points(data["location"])
+    data.loc[:,"latitude"] = xy[:, 0]
+    data.loc[:,"longitude"] = xy[:, 1]
+    return data.drop(columns=["location"])
+
+
+class CopyChunks(io.TextIOBase):
+    """Text sink for COPY ... TO STDOUT CSV HEADER.
+
+    psycopg2 writes one row per write() call. Rows are buffered until
+    chunksize of them arrived, then parsed into a DataFrame and passed to
+    on_chunk, so at most one chunk of the result is held in memory. dtype is
+    passed on to read_csv, so columns whose type read_csv would infer
+    differently from chunk to chunk can be pinned.
+    """
+
+    def __init__(self, on_chunk, chunksize, dtype=None):
+        self._on_chunk = on_chunk
+        self._chunksize = chunksize
+        self._dtype = dtype
+        self._header = None
+        self._rows = []
+
+    def writable(self):
+        return True
+
+    def write(self, row):
+        if self._header is None:
+            self._header = row
+        else:
+            self._rows.append(row)
+            if len(self._rows) >= self._chunksize:
+                self.flush_rows()
+        return len(row)
+
+    def flush_rows(self):
+        """Hand the buffered rows on as a DataFrame, if there are any."""
+        if self._rows:
+            rows, self._rows = self._rows, []
+            self._on_chunk(pd.read_csv(io.StringIO(self._header + "".join(rows)), sep=",", dtype=self._dtype))
+
+
+def arrow_schema(columns, coordinate_dtype="float64"):
+    """Arrow schema of export columns: categorical columns as
+        dictionary<int32, string>, coordinates as coordinate_dtype and
+        datetime as a timestamp. Fixed up front, so every chunk of a stream
+        has the same schema."""
+    import pyarrow as pa
+    types = {"datetime": pa.timestamp("us")}
+    types.update({c: pa.dictionary(pa.int32(), pa.string()) for c in CATEGORICAL_COLUMNS})
+    types.update({c: pa.from_numpy_dtype(np.dtype(coordinate_dtype)) for c in COORDINATE_COLUMNS})
+    return pa.schema([(c, types.get(c, pa.string())) for c in columns])
+
+
+class FrameWriter:
+    """Writes DataFrame chunks of one export to out in a format of
+        EXPORT_FORMATS.
+
+    out is a text stream for csv and ndjson and a binary one for arrow and
+    parquet. CSV gets its header once. Arrow and Parquet use arrow_schema
+    of the first chunk; Parquet columns are compressed with compression.
+    close() must be called to finish arrow and parquet output. When no
+    chunk was written, close() writes the CSV header or an empty Arrow
+    stream or Parquet file of columns.
+    """
+
+    def __init__(self, out, fmt="csv", compression="zstd", coordinate_dtype="float64", columns=EXPORT_COLUMNS):
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError("unknown export format: {}".format(fmt))
+        self.out = out
+        self.fmt = fmt
+        self.compression = compression
+        self.coordinate_dtype = coordinate_dtype
+        self.columns = columns
+        self.rows = 0
+        self.header_written = False
+        self._writer = None
+
+    def write(self, chunk):
+        if self.fmt == "csv":
+            chunk.to_csv(self.out, index=False, header=not self.header_written)
+            self.header_written = True
+        elif self.fmt == "ndjson":
+            if len(chunk):
+                lines = chunk.to_json(orient="records", lines=True, date_format="iso")
+                self.out.write(lines if lines.endswith("\n") else lines + "\n")
+        else:
+            self._write_columnar(chunk)
+        self.rows += len(chunk)
+        self.out.flush()
+
+    def _open(self, columns):
+        import pyarrow as pa
+        self.schema = arrow_schema(columns, self.coordinate_dtype)
+        if self.fmt == "arrow":
+            self._writer = pa.ipc.new_stream(self.out, self.schema)
+        else:
+            import pyarrow.parquet as pq
+            self._writer = pq.ParquetWriter(self.out, self.schema, compression=self.compression)
+
+    def _write_columnar(self, chunk):
+        import pyarrow as pa
+        if self._writer is None:
+            self._open(chunk.columns)
+        chunk = chunk.assign(datetime=pd.to_datetime(chunk["datetime"])) if "datetime" in chunk else chunk
+        self._writer.write_table(pa.Table.from_pandas(chunk, schema=self.schema, preserve_index=False))
+
+    def close(self):
+        if self.fmt == "csv" and not self.header_written:
+            pd.DataFrame(columns=self.columns).to_csv(self.out, index=False)
+            self.header_written = True
+        elif self.fmt not in TEXT_FORMATS and self._writer is None:
+            self._open(self.columns)
+        if self._writer is not None:
+            self._writer.close()
+        self.out.flush()
+
+
+def stream_copy(raw_conn, query, transform, out, chunksize=50000, fmt="csv", compression="zstd", coordinate_dtype="float64"):
+    """Run a COPY (...) TO STDOUT WITH CSV HEADER query and write
+        transform(chunk) of every chunk of rows to out with a FrameWriter
+        of fmt. String columns are read as strings in every chunk, also
+        when one chunk only has numbers or blanks in them. Returns the
+        number of rows written."""
+    writer = FrameWriter(out, fmt, compression, coordinate_dtype)
+    sink = CopyChunks(lambda chunk: writer.write(transform(chunk)), chunksize, {c: str for c in CATEGORICAL_COLUMNS + ["location"]})
+    cursor = raw_conn.cursor()
+    cursor.copy_expert(query, sink)
+    cursor.close()
+    sink.flush_rows()
+    writer.close()
+    return writer.rows
@@ -0,0 +1,142 @@
+"""Local binary cache of block and zipcode shapes, read through a memory map.
+
+File layout, little endian:
+    header   magic b"GEOC", uint32 version, uint64 count, 32 byte stamp
+    ids      int64[count]
+    bounds   float64[count, 4]     (xmin, ymin, xmax, ymax)
+    offsets  int64[count + 1]      into the WKB blob
+    blob     WKB of every shape, in id order
+
+The stamp is an md5 of the row count, the id range and sum and Postgres'
+counters of updated and deleted rows of the table, so checking a cache costs
+an index scan over the ids rather than reading every shape. Postgres reports
+those counters with a short delay, so a shape changed in the last second may
+go unnoticed; cached_shapes(verify=True) compares a full md5 of the shapes
+instead.
+"""
+
+from hashlib import md5
+import numpy as np
+import shapely
+import struct
+import os
+
+
+MAGIC = b"GEOC"
+VERSION = 2
+HEADER = struct.Struct("<4sIQ32s")
+
+
+class GeometryCache:
+    """Read-only view of a cache file. Nothing but the header is read until
+        ids, bounds or shapes are used."""
+
+    def __init__(self, path):
+        self.path = path
+        self._map = np.memmap(path, dtype=np.uint8, mode="r")
+        magic, version, count, stamp = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("{} is not a version {} geometry cache".format(path, VERSION))
+        self.stamp = stamp.decode("ascii")
+        pos = HEADER.size
+        self.ids = np.frombuffer(self._map, np.int64, count, pos)
+        pos += 8 * count
+        self.bounds = np.frombuffer(self._map, np.float64, 4 * count, pos).reshape(count, 4)
+        pos += 32 * count
+        self.offsets = np.frombuffer(self._map, np.int64, count + 1, pos)
+        self._blob = pos + 8 * (count + 1)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def wkb(self, i):
+        """WKB bytes of the i-th shape."""
+        return self._map[self._blob + self.offsets[i]:self._blob + self.offsets[i + 1]].tobytes()
+
+    def rows(self, indices=None):
+        """(id, wkb) rows, as fetched from the database."""
+        indices = range(len(self)) if indices is None else indices
+        return [(int(self.ids[i]), self.wkb(i)) for i in indices]
+
+    def geometries(self, indices=None):
+        """Shapely geometries, all or the given positions."""
+        indices = range(len(self)) if indices is None else indices
+        return shapely.from_wkb([self.wkb(i) for i in indices])
+
+    def in_bounds(self, xmin, ymin, xmax, ymax):
+        """Positions of shapes whose bounding box meets the given box."""
+        b = self.bounds
+        return np.flatnonzero((b[:, 0] <= xmax) & (b[:, 2] >= xmin) & (b[:, 1] <= ymax) & (b[:, 3] >= ymin))
+
+    def checksum(self):
+        """md5 over the ids and shapes, as table_checksum computes it."""
+        parts = ("{}:{}".format(int(self.ids[i]), md5(self.wkb(i)).hexdigest()) for i in range(len(self)))
+        return md5(",".join(parts).encode("ascii")).hexdigest()
+
+
+def write_cache(path, rows, stamp):
+    """Write (id, wkb) rows to a cache file, replacing it atomically."""
+    ids = np.array([r[0] for r in rows], dtype=np.int64)
+    wkbs = [bytes(r[1]) for r in rows]
+    bounds = shapely.bounds(shapely.from_wkb(wkbs)).reshape(len(wkbs), 4).astype(np.float64)
+    offsets = np.zeros(len(wkbs) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(w) for w in wkbs])
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(ids), stamp.encode("ascii")))
+        f.write(ids.tobytes())
+        f.write(bounds.tobytes())
+        f.write(offsets.tobytes())
+        for w in wkbs:
+            f.write(w)
+    os.replace(tmp, path)
+
+
+def table_stamp(raw_conn, table, where="TRUE", params=()):
+    """Cheap md5 that changes when rows matching where are added, removed or
+        updated, from the ids and the table's statistics counters."""
+    cursor = raw_conn.cursor()
+    cursor.execute("""
+        SELECT md5(concat_ws(':', COUNT(*), MIN(id), MAX(id), SUM(id),
+                             pg_stat_get_tuples_updated('{0}'::regclass),
+                             pg_stat_get_tuples_deleted('{0}'::regclass)))
+        FROM {0} WHERE {1};
+    """.format(table, where), params)
+    stamp = cursor.fetchone()[0]
+    cursor.close()
+    return stamp
+
+
+def table_checksum(raw_conn, table, where="TRUE", params=()):
+    """md5 over the ids and shapes of a table's rows, computed in Postgres."""
+    cursor = raw_conn.cursor()
+    cursor.execute("""
+        SELECT COALESCE(md5(string_agg(id::text || ':' || md5(ST_AsBinary(shape)), ',' ORDER BY id)), md5(''))
+        FROM {} WHERE {};
+    """.format(table, where), params)
+    checksum = cursor.fetchone()[0]
+    cursor.close()
+    return checksum
+
+
+def cached_shapes(raw_conn, table, path, where="TRUE", params=(), verify=False):
+    """GeometryCache of a table's (id, shape) rows matching where. The file at
+        path is reused while its stamp matches the table, and with verify
+        also its full checksum, otherwise the rows are fetched once and the
+        file rewritten."""
+    stamp = table_stamp(raw_conn, table, where, params)
+    if os.path.exists(path):
+        try:
+            cache = GeometryCache(path)
+        except ValueError:
+            cache = None
+        if cache is not None and cache.stamp == stamp:
+            if not verify or cache.checksum() == table_checksum(raw_conn, table, where, params):
+                return cache
+    cursor = raw_conn.cursor()
+    cursor.execute("SELECT id, ST_AsBinary(shape) FROM {} WHERE {} ORDER BY id;".format(table, where), params)
+    rows = cursor.fetchall()
+    cursor.close()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    write_cache(path, rows, stamp)
+    return GeometryCache(path)
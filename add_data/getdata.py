@@ -1,17 +1,38 @@
-from sqlalchemy import create_engine, text
-from sqlalchemy.orm import sessionmaker
 from decouple import config
-from geomet import wkb, wkt
-import pandas as pd
 
-import json
-import datetime
-import math
 import io
+import sys
+
+from export import TEXT_FORMATS, FrameWriter, format_locations, stream_copy
+from db import engine, raw_connection
+from jobs import JobRunner, stream_results
+from queries import PreparedQueries, ResultCache, cached_fetch, copy_query, normalize_filters
 
 # Connect to DB and create session with DB
 DB_URI  = config('DB_URI')
 
+# Stream the export in chunks of rows instead of holding the whole result
+STREAM_EXPORT    = config('STREAM_EXPORT', default=False, cast=bool)
+EXPORT_CHUNKSIZE = config('EXPORT_CHUNKSIZE', default=50000, cast=int)
+
+# Output format (csv, ndjson, arrow or parquet), Parquet compression and the
+# float type of the coordinate columns in arrow and parquet output
+EXPORT_FORMAT           = config('EXPORT_FORMAT', default='csv')
+EXPORT_COMPRESSION      = config('EXPORT_COMPRESSION', default='zstd')
+EXPORT_COORDINATE_DTYPE = config('EXPORT_COORDINATE_DTYPE', default='float64')
+OUT = sys.stdout if EXPORT_FORMAT in TEXT_FORMATS else sys.stdout.buffer
+
+# Results of repeated filter sets are served from memory for QUERY_CACHE_TTL seconds
+QUERY_CACHE_SIZE  = config('QUERY_CACHE_SIZE', default=128, cast=int)
+QUERY_CACHE_TTL   = config('QUERY_CACHE_TTL', default=300, cast=int)
+QUERY_CACHE_BYTES = config('QUERY_CACHE_BYTES', default=256 * 1024 * 1024, cast=int)
+CACHE = ResultCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL, QUERY_CACHE_BYTES)
+
+# Run the export as a background job and stream its chunks from the job tables,
+# which hold CSV whatever EXPORT_FORMAT is
+EXPORT_JOB  = config('EXPORT_JOB', default=False, cast=bool)
+JOB_WORKERS = config('JOB_WORKERS', default=1, cast=int)
+
 config_dict = {}
 config_dict["cityid"] = "1"
 config_dict["sdt"] = "04/01/2019"
@@ -24,44 +45,37 @@ locdesc1 = "".split(",")
 locdesc2 = "".split(",")
 locdesc3 = "".split(",")
 
-query_base    = " FROM incident "
-query_city    = "incident.cityid = {cityid}"
-query_date    = "incident.datetime >= TO_DATE('{sdt}', 'MM/DD/YYYY') AND datetime <= TO_DATE('{edt}', 'MM/DD/YYYY')"
-query_time    = "incident.hour >= {stime} AND hour <= {etime}"
-query_dotw    = "incident.dow = ANY({dotw})"
-query_crmtyp  = "crimetype.category = ANY({crimetypes})"
-query_locdesc = "(locdesctype.key1, locdesctype.key2, locdesctype.key3) = ANY({lockeys})"
-query_join    = "INNER JOIN crimetype ON incident.crimetypeid = crimetype.id INNER JOIN locdesctype ON incident.locdescid = locdesctype.id INNER JOIN city ON incident.cityid = city.id AND "
+FILTERS = normalize_filters(config_dict["cityid"], config_dict["sdt"], config_dict["edt"], config_dict["stime"], config_dict["etime"], dotw, crimetypes, locdesc1, locdesc2, locdesc3)
 
-base_list = [query_city, query_date, query_time]
-outputs   = ", ".join(["city.city", "city.state", "city.country", "incident.datetime", "incident.location", "crimetype.category", "locdesctype.key1 AS location_key1", "locdesctype.key2 AS location_key2", "locdesctype.key3 AS location_key3"])
-if dotw != "":
-    config_dict["dotw"] = dotw.split(",")
-    base_list.append(query_dotw)
-if crimetypes != "":
-    config_dict["crimetypes"] = ["'{}'".format(x) for x in crimetypes.split(",")]
-    config_dict["crimetypes"] = "ARRAY[{}]".format(", ".join(config_dict["crimetypes"]))
-    base_list.append(query_crmtyp)
-if locdesc1 != [""] and locdesc2 != [""] and locdesc3 != [""] and len(locdesc1) == len(locdesc2) and len(locdesc2) == len(locdesc3):
-    config_dict["lockeys"] = []
-    for i in range(len(locdesc1)):
-        config_dict["lockeys"].append("('{}', '{}', '{}')".format(locdesc1[i], locdesc2[i], locdesc3[i]))
-    config_dict["lockeys"] = "ARRAY[{}]".format(", ".join(config_dict["lockeys"]))
-    base_list.append(query_locdesc)
-
-query = "COPY (SELECT " + outputs + query_base + query_join + (" AND ".join(base_list)).format(**config_dict) +") TO STDOUT WITH DELIMITER ',' CSV HEADER;"
-with io.StringIO() as f:
-    RAW_CONN = create_engine(DB_URI).raw_connection()
+if EXPORT_JOB:
+    ENGINE = engine(DB_URI)
+    RUNNER = JobRunner(ENGINE, JOB_WORKERS, chunksize=EXPORT_CHUNKSIZE, cache=CACHE)
+    JOBID = RUNNER.submit("export", dict(config_dict, dotw=dotw, crimetypes=crimetypes, locdesc1=locdesc1, locdesc2=locdesc2, locdesc3=locdesc3))
+    RAW_CONN = ENGINE.raw_connection()
+    JOB = stream_results(RAW_CONN, JOBID, sys.stdout)
+    RAW_CONN.close()
+    RUNNER.close()
+    if JOB["status"] != "finished":
+        sys.exit("job {} {}: {}".format(JOBID, JOB["status"], JOB["result"].get("error")))
+elif STREAM_EXPORT:
+    RAW_CONN = raw_connection(DB_URI)
     cursor = RAW_CONN.cursor()
-    cursor.copy_expert(query, f)
+    query = copy_query(cursor, FILTERS)
     cursor.close()
+    stream_copy(RAW_CONN, query, format_locations, OUT, EXPORT_CHUNKSIZE, EXPORT_FORMAT, EXPORT_COMPRESSION, EXPORT_COORDINATE_DTYPE)
     RAW_CONN.close()
-    f.seek(0)
-    data = pd.read_csv(f, sep=",")
-    data.loc[:,"location"] = data.loc[:,"location"].apply(lambda x: [float(y) for y in wkt.dumps(wkb.loads(bytes.fromhex(x))).replace("(", "").replace(")", "").split(" ")[1:]])
-    data.loc[:,"latitude"] = data.loc[:,"location"].apply(lambda x: x[0])
-    data.loc[:,"longitude"] = data.loc[:,"location"].apply(lambda x: x[1])
-    data = data.drop(columns=["location"])
-with io.StringIO() as f:
-    data.to_csv(f, index=False)
-    print(f.getvalue())
+else:
+    RAW_CONN = raw_connection(DB_URI)
+    data = cached_fetch(PreparedQueries(RAW_CONN), CACHE, FILTERS, format_locations)
+    RAW_CONN.close()
+    if EXPORT_FORMAT == "csv":
+        with io.StringIO() as f:
+            data.to_csv(f, index=False)
+            print(f.getvalue())
+    else:
+        WRITER = FrameWriter(OUT, EXPORT_FORMAT, EXPORT_COMPRESSION, EXPORT_COORDINATE_DTYPE)
+        WRITER.write(data)
+        WRITER.close()
+
+if not STREAM_EXPORT or EXPORT_JOB:
+    print("query cache: {hits} hits, {misses} misses, {evictions} evictions, {entries} entries, {bytes} bytes".format(**CACHE.stats()), file=sys.stderr)
@@ -0,0 +1,53 @@
+"""Drop and rebuild secondary indexes around bulk loads."""
+
+from db import unpooled_connection
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+
+def _connect(db_uri):
+    """New autocommit DBAPI connection, needed for CREATE INDEX CONCURRENTLY."""
+    return unpooled_connection(db_uri, autocommit=True)
+
+
+def drop_indexes(db_uri, indexes):
+    """Drop the given (name, definition) indexes if they exist."""
+    conn = _connect(db_uri)
+    cursor = conn.cursor()
+    for name, _ in indexes:
+        cursor.execute("DROP INDEX IF EXISTS {};".format(name))
+    cursor.close()
+    conn.close()
+
+
+def _build_index(db_uri, name, definition, concurrently, work_mem):
+    """Create one index on its own connection and return (name, seconds)."""
+    conn = _connect(db_uri)
+    cursor = conn.cursor()
+    cursor.execute("SET maintenance_work_mem = %s;", (work_mem,))
+    start = time.perf_counter()
+    cursor.execute("CREATE INDEX {}IF NOT EXISTS {} ON {};".format("CONCURRENTLY " if concurrently else "", name, definition))
+    elapsed = time.perf_counter() - start
+    cursor.close()
+    conn.close()
+    return name, elapsed
+
+
+def build_indexes(db_uri, indexes, workers=1, concurrently=False, work_mem="256MB"):
+    """Create (name, definition) indexes over `workers` connections at once.
+
+    Largest tables are listed first by the callers, so they start early.
+    Concurrent builds on the same table wait for each other and scan it
+    twice, so concurrently is for refreshing a database in use; bulk loads
+    build plainly. Returns (name, seconds) per index in the given order.
+    """
+    with ThreadPoolExecutor(max(1, workers)) as pool:
+        futures = [pool.submit(_build_index, db_uri, name, definition, concurrently, work_mem) for name, definition in indexes]
+        return [f.result() for f in futures]
+
+
+def print_index_report(timings, wall):
+    """Print per-index build times, slowest first."""
+    for name, elapsed in sorted(timings, key=lambda x: -x[1]):
+        print("\t{:<30} {:>8.2f}s".format(name, elapsed))
+    print("\t{:<30} {:>8.2f}s wall, {:.2f}s summed".format("all indexes", wall, sum(x[1] for x in timings)))
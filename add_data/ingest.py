@@ -0,0 +1,323 @@
+"""Stream transformed DataFrame chunks into Postgres with COPY."""
+
+import numpy as np
+import pandas as pd
+import shapely
+from cube import refresh_cube
+from transforms import POINT_WKB
+import multiprocessing
+import multiprocessing.util
+import os
+import struct
+import io
+
+
+# Per-process state of a parallel ingest worker, and the staging table
+# columns that keep the order of the shards
+_WORKER = {}
+ORDER_COLUMNS = ["load_shard", "load_row"]
+
+# Binary COPY framing and the binary type of each SQLAlchemy column type
+COPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+COPY_TRAILER = struct.pack(">h", -1)
+PG_EPOCH = np.datetime64("2000-01-01T00:00:00", "us")
+BINARY_TYPES = {
+    "BigInteger": "int8",
+    "Integer": "int4",
+    "DateTime": "timestamp",
+    "Geometry": "geometry",
+    "String": "text",
+    "LargeBinary": "bytea",
+}
+
+
+class ChunkStream(io.RawIOBase):
+    """Read-only file object over an iterator of bytes chunks.
+
+    Only the chunk currently being read is held in memory, so COPY can pull
+    from a generator of any length.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = memoryview(b"")
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self._pos >= len(self._buf):
+            try:
+                self._buf = memoryview(next(self._chunks))
+            except StopIteration:
+                return 0
+            self._pos = 0
+        n = min(len(b), len(self._buf) - self._pos)
+        b[:n] = self._buf[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+
+def csv_chunks(frames, columns):
+    """Encode each DataFrame as header-less CSV bytes in the given column order."""
+    for frame in frames:
+        if len(frame) > 0:
+            yield frame.loc[:, columns].to_csv(header=False, index=False).encode("utf-8")
+
+
+def binary_types(table, columns):
+    """{column: binary type} for columns of a SQLAlchemy Table."""
+    return {c: BINARY_TYPES[type(table.c[c].type).__name__] for c in columns}
+
+
+def _fixed_fields(data, width):
+    """(rows, 4 + width) bytes of length-prefixed fields from a contiguous
+        big endian array, or from an equal-width bytes matrix."""
+    out = np.empty((len(data), 4 + width), dtype=np.uint8)
+    out[:, :4] = np.frombuffer(struct.pack(">i", width), dtype=np.uint8)
+    out[:, 4:] = np.ascontiguousarray(data).view(np.uint8).reshape(len(data), width)
+    return out
+
+
+def _bytes_fields(values):
+    """Length-prefixed fields of bytes values, as a matrix when all have the
+        same length (e.g. 2D points) and as a list otherwise."""
+    lengths = set(len(v) for v in values)
+    if len(lengths) == 1:
+        width = lengths.pop()
+        return _fixed_fields(np.frombuffer(b"".join(values), dtype=np.uint8).reshape(len(values), width), width)
+    return [struct.pack(">i", len(v)) + v for v in values]
+
+
+def encode_column(values, pgtype):
+    """Binary COPY fields of one non-null column. Geometries may be given as
+        shapely objects or WKT and are sent as EWKB; bytea values as bytes."""
+    if pgtype == "int8":
+        return _fixed_fields(np.asarray(values, dtype=">i8"), 8)
+    if pgtype == "int4":
+        return _fixed_fields(np.asarray(values, dtype=">i4"), 4)
+    if pgtype == "timestamp":
+        micros = (pd.to_datetime(values).values.astype("datetime64[us]") - PG_EPOCH).astype(np.int64)
+        return _fixed_fields(micros.astype(">i8"), 8)
+    if pgtype == "geometry":
+        geoms = np.asarray(values, dtype=object)
+        if len(geoms) and isinstance(geoms[0], str):
+            geoms = shapely.from_wkt(geoms)
+        if len(geoms) and (shapely.get_type_id(geoms) == 0).all() and not (shapely.has_z(geoms) | shapely.is_empty(geoms)).any():
+            points = np.empty(len(geoms), dtype=POINT_WKB)
+            points["order"] = 1
+            points["type"] = 1
+            points["x"] = shapely.get_x(geoms)
+            points["y"] = shapely.get_y(geoms)
+            return _fixed_fields(points, POINT_WKB.itemsize)
+        return _bytes_fields(list(shapely.to_wkb(geoms, flavor="extended")))
+    if pgtype == "text":
+        return _bytes_fields([str(v).encode("utf-8") for v in values])
+    if pgtype == "bytea":
+        return _bytes_fields([bytes(v) for v in values])
+    raise ValueError("no binary COPY encoder for {}".format(pgtype))
+
+
+def encode_binary(frame, columns, types):
+    """Tuples of one DataFrame in PostgreSQL binary COPY format, without the
+        file header and trailer. Runs of fixed-width fields are packed as one
+        matrix; rows are only joined one by one when a field varies in width."""
+    parts = [np.frombuffer(struct.pack(">h", len(columns)) * len(frame), dtype=np.uint8).reshape(len(frame), 2)]
+    for c in columns:
+        field = encode_column(frame[c].values, types[c])
+        if isinstance(field, np.ndarray) and isinstance(parts[-1], np.ndarray):
+            parts[-1] = np.hstack([parts[-1], field])
+        else:
+            parts.append(field)
+    if len(parts) == 1:
+        return parts[0].tobytes()
+    parts = [[row.tobytes() for row in p] if isinstance(p, np.ndarray) else p for p in parts]
+    return b"".join(b"".join(row) for row in zip(*parts))
+
+
+def binary_chunks(frames, columns, types):
+    """Encode DataFrames as one binary COPY stream."""
+    yield COPY_SIGNATURE
+    for frame in frames:
+        if len(frame) > 0:
+            yield encode_binary(frame, columns, types)
+    yield COPY_TRAILER
+
+
+def read_chunks(csv_file_path, transform, chunksize, **kwargs):
+    """Read a source CSV in fixed-size chunks and yield transform(chunk)."""
+    for chunk in pd.read_csv(csv_file_path, chunksize=chunksize, **kwargs):
+        yield transform(chunk)
+
+
+def copy_frames(raw_conn, table, columns, frames, buffer_size=1 << 16, types=None):
+    """COPY an iterable of DataFrames into table over one open COPY stream.
+        With types ({column: binary type}, see binary_types) the rows are
+        sent in binary format instead of CSV."""
+    if types is None:
+        stream = io.BufferedReader(ChunkStream(csv_chunks(frames, columns)), buffer_size)
+        cmd = "COPY {}({}) FROM STDIN DELIMITER ',' CSV;".format(table, ",".join(columns))
+    else:
+        stream = io.BufferedReader(ChunkStream(binary_chunks(frames, columns, types)), buffer_size)
+        cmd = "COPY {}({}) FROM STDIN (FORMAT binary);".format(table, ",".join(columns))
+    cursor = raw_conn.cursor()
+    cursor.copy_expert(cmd, stream, size=buffer_size)
+    rows = cursor.rowcount
+    cursor.close()
+    raw_conn.commit()
+    return rows
+
+
+def _init_worker(db_uri, table, columns, transform, initializer, initargs, types):
+    """Open this worker's COPY connection and run the caller's setup once."""
+    from db import unpooled_connection
+    if initializer is not None:
+        initializer(*initargs)
+    _WORKER["conn"] = unpooled_connection(db_uri)
+    multiprocessing.util.Finalize(None, _WORKER["conn"].close, exitpriority=10)
+    _WORKER["table"] = table
+    _WORKER["columns"] = columns + ORDER_COLUMNS
+    _WORKER["transform"] = transform
+    _WORKER["types"] = None if types is None else dict(types, load_shard="int4", load_row="int8")
+
+
+def _copy_shard(index, chunk):
+    """Transform one shard and COPY it on this worker's connection, each row
+        tagged with the shard index and its position in the shard."""
+    frame = _WORKER["transform"](chunk)
+    frame = frame.assign(load_shard=index, load_row=np.arange(len(frame)))
+    return copy_frames(_WORKER["conn"], _WORKER["table"], _WORKER["columns"], [frame], types=_WORKER["types"])
+
+
+def _execute(db_uri, *statements):
+    """Run statements in one transaction on a short-lived connection."""
+    from db import unpooled_connection
+    conn = unpooled_connection(db_uri)
+    cursor = conn.cursor()
+    for sql in statements:
+        cursor.execute(sql)
+    cursor.close()
+    conn.commit()
+    conn.close()
+
+
+def parallel_copy(db_uri, table, columns, shards, transform, workers, initializer=None, initargs=(), types=None):
+    """Transform shards in worker processes, each COPYing on its own connection.
+
+    Workers COPY into an unlogged staging table, which is moved into table
+    in one transaction once every shard is in, so a failed shard leaves
+    table as it was, as a serial COPY would. Rows are moved in shard order,
+    so they get the same ids and order as from a serial COPY even though
+    workers finish out of order. The staging table is dropped either way.
+
+    initializer(*initargs) runs once per worker before any shard, e.g. to load
+    block geometries. Workers are forked so module state of the caller (lookup
+    dicts, settings) is shared without pickling. At most two shards per worker
+    are in flight, keeping memory bounded. types is passed on to copy_frames.
+    Returns the number of rows copied.
+    """
+    staging = "{}_load_{}".format(table, os.getpid())
+    _execute(db_uri, "DROP TABLE IF EXISTS {};".format(staging),
+             "CREATE UNLOGGED TABLE {} AS SELECT {}, 0 AS load_shard, 0::bigint AS load_row FROM {} WITH NO DATA;".format(staging, ", ".join(columns), table))
+    ctx = multiprocessing.get_context("fork")
+    pool = ctx.Pool(workers, _init_worker, (db_uri, staging, columns, transform, initializer, initargs, types))
+    pending = []
+    rows = 0
+    try:
+        for index, shard in enumerate(shards):
+            pending.append(pool.apply_async(_copy_shard, (index, shard)))
+            if len(pending) >= 2 * workers:
+                rows += pending.pop(0).get()
+        for result in pending:
+            rows += result.get()
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        pool.join()
+        _execute(db_uri, "DROP TABLE IF EXISTS {};".format(staging))
+        raise
+    pool.join()
+    cols = ", ".join(columns)
+    _execute(db_uri, "INSERT INTO {} ({}) SELECT {} FROM {} ORDER BY load_shard, load_row;".format(table, cols, cols, staging),
+             "DROP TABLE {};".format(staging))
+    return rows
+
+
+def read_watermark(raw_conn, cityid):
+    """Latest incident datetime loaded for a city, or None if it has none.
+        Falls back to the incident table when no mark was saved yet."""
+    cursor = raw_conn.cursor()
+    cursor.execute("SELECT datetime FROM ingeststate WHERE cityid = %s;", (cityid,))
+    row = cursor.fetchone()
+    if row is None:
+        cursor.execute("SELECT MAX(datetime) FROM incident WHERE cityid = %s;", (cityid,))
+        row = cursor.fetchone()
+    cursor.close()
+    return row[0]
+
+
+def save_watermark(raw_conn, cityid):
+    """Record the latest loaded incident datetime for a city. Not committed."""
+    cursor = raw_conn.cursor()
+    cursor.execute("""
+        INSERT INTO ingeststate (cityid, datetime)
+        SELECT cityid, MAX(datetime) FROM incident WHERE cityid = %s GROUP BY cityid
+        ON CONFLICT (cityid) DO UPDATE SET datetime = EXCLUDED.datetime;
+    """, (cityid,))
+    cursor.close()
+
+
+def merge_incidents(raw_conn, cityid, columns, frames, since, assign_blocks=False, types=None):
+    """COPY new incidents into a staging table and merge them into incident.
+
+    frames should only hold incidents at or after `since`. Rows exactly at
+    `since` are skipped when the same incident is already loaded, so a refresh
+    can overlap the previous one by a timestamp without duplicating it. The
+    merge, the recount of the merged months in incidentcube and the new
+    watermark are committed together, so the cube never lags the watermark.
+
+    With assign_blocks the frames' blockid is ignored and every incident gets
+    the first block (by id) whose shape contains it, found with ST_Contains
+    over the GiST index geoalchemy2 keeps on block.shape. Incidents outside
+    every block are dropped, as in the Python path. types is passed on to
+    copy_frames for the staging COPY.
+    """
+    staged = [c for c in columns if not (assign_blocks and c == "blockid")]
+    cursor = raw_conn.cursor()
+    cursor.execute("CREATE TEMPORARY TABLE incident_staging AS SELECT {} FROM incident WITH NO DATA;".format(", ".join(staged)))
+    cursor.close()
+    raw_conn.commit()
+    copy_frames(raw_conn, "incident_staging", staged, frames, types=types)
+    cursor = raw_conn.cursor()
+    cursor.execute("ANALYZE incident_staging;")
+    if assign_blocks:
+        select = ", ".join("b.id" if c == "blockid" else "s." + c for c in columns)
+        block_join = """
+        CROSS JOIN LATERAL (
+            SELECT block.id FROM block
+            WHERE ST_Contains(block.shape, s.location)
+            ORDER BY block.id LIMIT 1
+        ) b"""
+    else:
+        select = ", ".join("s." + c for c in columns)
+        block_join = ""
+    cursor.execute("""
+        INSERT INTO incident ({cols})
+        SELECT {select} FROM incident_staging s{block_join}
+        WHERE s.datetime > %(since)s OR %(since)s IS NULL OR NOT EXISTS (
+            SELECT 1 FROM incident i
+            WHERE i.cityid = s.cityid
+                AND i.datetime = s.datetime
+                AND i.crimetypeid = s.crimetypeid
+                AND i.locdescid = s.locdescid
+                AND ST_Equals(i.location, s.location)
+        );
+    """.format(cols=", ".join(columns), select=select, block_join=block_join), {"since": since})
+    rows = cursor.rowcount
+    cursor.execute("DROP TABLE incident_staging;")
+    cursor.close()
+    refresh_cube(raw_conn, cityid, since)
+    save_watermark(raw_conn, cityid)
+    raw_conn.commit()
+    return rows
@@ -0,0 +1,191 @@
+"""Background export and prediction jobs recorded in the job table.
+
+JobRunner stands in for the redis queue the Job model was written for:
+submitted jobs wait in a bounded in-process queue and a fixed number of
+worker threads run them, each on a connection of the shared db.engine()
+pool, so any number of callers share a fixed number of connections. The
+output of a job is stored in jobchunk as CSV chunks while it is produced,
+and its status and a JSON summary in job, so callers can poll status() or
+read the rows with stream_results() before the job is done. Given a
+ResultCache, export jobs of recently exported filter sets are served from
+it instead of the database.
+"""
+
+from export import EXPORT_COLUMNS, format_locations
+from predictions import read_predictions
+from queries import COLUMNS, PreparedQueries, cached_fetch, filter_params, normalize_filters, statement
+import pandas as pd
+import json
+import queue
+import threading
+import time
+
+
+QUEUED = "queued"
+RUNNING = "running"
+FINISHED = "finished"
+FAILED = "failed"
+
+
+def export_job(raw_conn, params, emit, chunksize, cache=None):
+    """Incidents of a getdata filter set (the keyword arguments of
+        normalize_filters), with latitude and longitude columns. Without a
+        cache, rows are read through a cursor held over commits, so chunks
+        can be written on the same connection in between. A filter set
+        without incidents gives one empty chunk, so the output has its
+        header."""
+    filters = normalize_filters(**params)
+    if cache is not None:
+        data = cached_fetch(PreparedQueries(raw_conn), cache, filters, format_locations)
+        for start in range(0, max(len(data), 1), chunksize):
+            emit(data.iloc[start:start + chunksize])
+        return
+    sql, _ = statement(filters, lambda i: "%s")
+    cursor = raw_conn.cursor(name="export_job", withhold=True)
+    cursor.execute(sql, filter_params(filters))
+    chunks = 0
+    while True:
+        rows = cursor.fetchmany(chunksize)
+        if not rows:
+            break
+        emit(format_locations(pd.DataFrame.from_records(rows, columns=COLUMNS)))
+        chunks += 1
+    cursor.close()
+    if chunks == 0:
+        emit(pd.DataFrame(columns=EXPORT_COLUMNS))
+
+
+def prediction_job(raw_conn, params, emit, chunksize, cache=None):
+    """Predictions of every block of a city (cityid, model_version and
+        optionally year and month), one row per block with the (12, 7, 24)
+        array flattened into a JSON list. A city without predictions gives
+        one empty chunk, so the output has its header."""
+    blockids, X = read_predictions(raw_conn, params["cityid"], params.get("model_version", "v1"), params.get("year"), params.get("month"))
+    for start in range(0, max(len(blockids), 1), chunksize):
+        emit(pd.DataFrame({
+            "blockid": blockids[start:start + chunksize],
+            "prediction": [json.dumps(x.ravel().tolist()) for x in X[start:start + chunksize]],
+        }))
+
+
+HANDLERS = {
+    "export": export_job,
+    "prediction": prediction_job,
+}
+
+
+class JobRunner:
+    """Runs submitted jobs on a fixed pool of worker threads.
+
+    engine is normally db.engine(); its pool should hold more than workers
+    connections, so submit and status calls still get one. submit() blocks
+    while queue_size jobs are already waiting, so a burst of requests is
+    held back instead of piling up. close() lets queued jobs finish first.
+    cache, a ResultCache, is shared by the jobs of all workers.
+    """
+
+    def __init__(self, engine, workers=4, queue_size=64, chunksize=50000, cache=None):
+        self.engine = engine
+        self.chunksize = chunksize
+        self.cache = cache
+        self.queue = queue.Queue(queue_size)
+        self.threads = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, kind, params):
+        """Record a job of a kind in HANDLERS as queued and queue it.
+            params must be JSON serializable. Returns the job id."""
+        if kind not in HANDLERS:
+            raise ValueError("unknown job kind: {}".format(kind))
+        raw_conn = self.engine.raw_connection()
+        cursor = raw_conn.cursor()
+        cursor.execute("""
+            INSERT INTO job (result, datetime, kind, params, status, updated)
+            VALUES ('{}', now(), %s, %s, %s, now()) RETURNING id;
+        """, (kind, json.dumps(params), QUEUED))
+        jobid = cursor.fetchone()[0]
+        cursor.close()
+        raw_conn.commit()
+        raw_conn.close()
+        self.queue.put((jobid, kind, params))
+        return jobid
+
+    def close(self):
+        """Stop the workers once the queue is empty."""
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            raw_conn = self.engine.raw_connection()
+            try:
+                self._run(raw_conn, *job)
+            finally:
+                raw_conn.close()
+
+    def _run(self, raw_conn, jobid, kind, params):
+        """Run one job, committing each chunk of output as it comes."""
+        state = {"seq": 0, "rows": 0}
+        cursor = raw_conn.cursor()
+
+        def set_status(status, result):
+            cursor.execute("UPDATE job SET status = %s, result = %s, updated = now() WHERE id = %s;", (status, json.dumps(result), jobid))
+            raw_conn.commit()
+
+        def emit(chunk):
+            data = chunk.to_csv(index=False, header=state["seq"] == 0).encode()
+            cursor.execute("INSERT INTO jobchunk (jobid, seq, rows, data) VALUES (%s, %s, %s, %s);", (jobid, state["seq"], len(chunk), data))
+            state["seq"] += 1
+            state["rows"] += len(chunk)
+            set_status(RUNNING, {"rows": state["rows"], "chunks": state["seq"]})
+
+        set_status(RUNNING, {"rows": 0, "chunks": 0})
+        try:
+            HANDLERS[kind](raw_conn, params, emit, self.chunksize, self.cache)
+        except Exception as e:
+            raw_conn.rollback()
+            cursor.execute("CLOSE ALL;")
+            set_status(FAILED, {"rows": state["rows"], "chunks": state["seq"], "error": repr(e)})
+        else:
+            set_status(FINISHED, {"rows": state["rows"], "chunks": state["seq"]})
+        cursor.close()
+
+
+def status(raw_conn, jobid):
+    """Status, kind and summary of a job, or None if there is no such job."""
+    cursor = raw_conn.cursor()
+    cursor.execute("SELECT status, kind, result, updated FROM job WHERE id = %s;", (jobid,))
+    row = cursor.fetchone()
+    cursor.close()
+    raw_conn.rollback()
+    if row is None:
+        return None
+    return {"status": row[0], "kind": row[1], "result": json.loads(row[2]), "updated": row[3]}
+
+
+def stream_results(raw_conn, jobid, out, poll=0.5):
+    """Write the CSV output of a job to out as its chunks arrive, header
+        once, until the job has finished or failed. Returns the final
+        status()."""
+    seq = 0
+    cursor = raw_conn.cursor()
+    while True:
+        job = status(raw_conn, jobid)
+        cursor.execute("SELECT data FROM jobchunk WHERE jobid = %s AND seq >= %s ORDER BY seq;", (jobid, seq))
+        chunks = cursor.fetchall()
+        raw_conn.rollback()
+        for (data,) in chunks:
+            out.write(bytes(data).decode())
+            seq += 1
+        out.flush()
+        if job is None or job["status"] in (FINISHED, FAILED):
+            cursor.close()
+            return job
+        if not chunks:
+            time.sleep(poll)
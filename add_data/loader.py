@@ -0,0 +1,262 @@
+"""Load registered cities into a crime database: the city row, block and
+zipcode shapes and incidents of each city, and the secondary indexes around
+them.
+
+The createdb driver of a schema only declares what differs between schemas:
+its tables, the columns of the bulk loaded ones, its indexes and how raw
+crime and location descriptions map to crimetype and locdesctype ids. The
+settings below are read from the environment like the drivers' own.
+"""
+
+from decouple import config, Csv
+from functools import partial
+import pandas as pd
+import shapely
+from blockindex import BlockIndex
+from geomcache import cached_shapes
+from cities import CITIES, run_cities
+from cube import refresh_cube
+from db import copy_in, engine, print_report, raw_connection
+from indexes import build_indexes, drop_indexes, print_index_report
+from ingest import binary_types, copy_frames, merge_incidents, parallel_copy, read_chunks, read_watermark, save_watermark
+from taxonomy import compile_lookup, map_lookup
+from transforms import add_time_columns
+import time
+import os
+
+
+# Incident ingest settings
+STREAM_INGEST    = config('STREAM_INGEST', default=False, cast=bool)
+INGEST_CHUNKSIZE = config('INGEST_CHUNKSIZE', default=100000, cast=int)
+INGEST_WORKERS   = config('INGEST_WORKERS', default=1, cast=int)
+INCREMENTAL_INGEST = config('INCREMENTAL_INGEST', default=False, cast=bool)
+BLOCK_ENGINE     = config('BLOCK_ENGINE', default='python')
+BINARY_COPY      = config('BINARY_COPY', default=False, cast=bool)
+
+# Registered cities to load, how many at once, where cached block shapes go
+# (geometry_cache in the formatted CSV directory by default) and whether to
+# check the cache against a full checksum of the shapes rather than the stamp
+INGEST_CITIES = config('INGEST_CITIES', default='chicago,la', cast=Csv())
+CITY_WORKERS  = config('CITY_WORKERS', default=1, cast=int)
+GEOMETRY_CACHE_DIR = config('GEOMETRY_CACHE_DIR', default='')
+GEOMETRY_CACHE_VERIFY = config('GEOMETRY_CACHE_VERIFY', default=False, cast=bool)
+
+# Index build settings
+DEFER_INDEXES      = config('DEFER_INDEXES', default=False, cast=bool)
+INDEX_WORKERS      = config('INDEX_WORKERS', default=1, cast=int)
+INDEX_CONCURRENTLY = config('INDEX_CONCURRENTLY', default=False, cast=bool)
+INDEX_WORK_MEM     = config('INDEX_WORK_MEM', default='256MB')
+
+# Indexes the incremental watermark lookup and merge_incidents rely on, kept
+# while loading when DEFER_INDEXES and INCREMENTAL_INGEST are both set
+INCREMENTAL_INDEXES = ["incident_citydatetime_idx"]
+# Tables an incremental run creates when they are missing, e.g. on a
+# database loaded before they were added
+INCREMENTAL_TABLES = ["ingeststate", "incidentcube", "job", "jobchunk"]
+
+
+class CityLoader:
+    """Loads registered cities into the database of db_uri.
+
+    metadata is the SQLAlchemy MetaData of the schema, table_columns the
+    columns COPYed into each bulk loaded table and indexes its secondary
+    (name, definition) indexes, largest tables first. Formatted CSVs are
+    written under formatted_dir. set_lookups() must be called once the
+    crimetype and locdesctype rows exist, before run().
+    """
+
+    def __init__(self, db_uri, metadata, table_columns, indexes, formatted_dir="."):
+        self.db_uri = db_uri
+        self.metadata = metadata
+        self.table_columns = table_columns
+        self.indexes = indexes
+        self.formatted_dir = formatted_dir
+        self.geometry_cache_dir = GEOMETRY_CACHE_DIR or os.path.join(formatted_dir, "geometry_cache")
+        # Binary COPY types of the bulk loaded tables, used when BINARY_COPY is set
+        self.copy_types = {t: binary_types(metadata.tables[t], table_columns[t]) for t in ["block", "zipcodegeom", "incident"]} if BINARY_COPY else {}
+        self.cityid = None
+        self.watermark = None
+        self.block_rows = []
+        self.block_index = None
+
+    def deferred_indexes(self):
+        """Indexes dropped while loading with DEFER_INDEXES."""
+        return [i for i in self.indexes if not (INCREMENTAL_INGEST and i[0] in INCREMENTAL_INDEXES)]
+
+    def create_indexes(self):
+        """Build the secondary indexes, INDEX_WORKERS at a time, and print how
+            long each one took. INDEX_CONCURRENTLY only applies to incremental
+            runs; after a reset nothing else uses the tables, and plain builds
+            of the same table do not wait for each other."""
+        start = time.perf_counter()
+        timings = build_indexes(self.db_uri, self.indexes, INDEX_WORKERS, INDEX_CONCURRENTLY and INCREMENTAL_INGEST, INDEX_WORK_MEM)
+        print_index_report(timings, time.perf_counter() - start)
+
+    def prepare(self):
+        """Drop the deferred indexes, then reset every table on a full load,
+            or create the missing INCREMENTAL_TABLES on an incremental one."""
+        if DEFER_INDEXES:
+            drop_indexes(self.db_uri, self.deferred_indexes())
+        bind = engine(self.db_uri)
+        if INCREMENTAL_INGEST:
+            self.metadata.create_all(bind=bind, tables=[self.metadata.tables[t] for t in INCREMENTAL_TABLES])
+        else:
+            self.metadata.drop_all(bind=bind)
+            self.metadata.create_all(bind=bind)
+            if not DEFER_INDEXES:
+                self.create_indexes()
+            print("reset")
+
+    def set_lookups(self, crimetypes, loctypes):
+        """Taxonomy of the schema as (descriptions, resolve) pairs, one for
+            crime and one for location descriptions. resolve maps a raw
+            description to its crimetype or locdesctype id, and every
+            description of descriptions is resolved once up front."""
+        self.find_crimetypeid = crimetypes[1]
+        self.find_loctypeid = loctypes[1]
+        self.crimetype_lookup = compile_lookup(crimetypes[0], crimetypes[1])
+        self.loctype_lookup = compile_lookup(loctypes[0], loctypes[1])
+
+    def run(self, names=None):
+        """Ingest the registered cities of names (INGEST_CITIES by default),
+            CITY_WORKERS at a time, then build the deferred indexes and print
+            the statement report. The caller must not hold pooled connections
+            open, since city workers are forked."""
+        engine(self.db_uri).dispose()
+        run_cities(names or INGEST_CITIES, self.ingest_city, CITY_WORKERS)
+        if DEFER_INDEXES:
+            self.create_indexes()
+            print("indexes")
+        print_report()
+
+    def add_formatted_data(self, csv_file_path, table_type):
+        with open(csv_file_path, 'r') as f:
+            raw_conn = raw_connection(self.db_uri)
+            copy_in(raw_conn, table_type, self.table_columns[table_type], f)
+            raw_conn.close()
+
+    def add_shapes(self, shapes, table_type, formatted_path):
+        """COPY a frame with shapely shapes into block or zipcodegeom. With
+            BINARY_COPY the shapes are sent as EWKB, otherwise through a
+            formatted WKT CSV."""
+        if BINARY_COPY:
+            raw_conn = raw_connection(self.db_uri)
+            copy_frames(raw_conn, table_type, self.table_columns[table_type], [shapes], types=self.copy_types[table_type])
+            raw_conn.close()
+        else:
+            shapes = shapes.assign(shape=shapely.to_wkt(shapes["shape"].values, rounding_precision=-1))
+            shapes.to_csv(formatted_path, index=False)
+            self.add_formatted_data(formatted_path, table_type)
+
+    def load_incidents(self, csv_file_path, formatted_path, transform):
+        """Format a city's crime file and COPY it into the incident table. With
+            STREAM_INGEST the file is read in chunks that go straight into one
+            COPY without writing the formatted CSV. With INGEST_WORKERS > 1 the
+            chunks are formatted and copied by that many worker processes. With
+            INCREMENTAL_INGEST only incidents from the city's watermark on are
+            formatted, staged and merged in. With BLOCK_ENGINE=postgis incidents
+            are staged and get their blockid from ST_Contains in the database.
+            With BINARY_COPY incidents are streamed in chunks in binary COPY
+            format in every mode. The months that got incidents are recounted
+            in incidentcube in the transaction that moves the watermark."""
+        columns = self.table_columns["incident"]
+        types = self.copy_types.get("incident")
+        raw_conn = raw_connection(self.db_uri)
+        if INCREMENTAL_INGEST or BLOCK_ENGINE == "postgis":
+            if INCREMENTAL_INGEST:
+                self.watermark = read_watermark(raw_conn, self.cityid)
+                print("\tloading incidents from {}".format(self.watermark))
+            chunks = read_chunks(csv_file_path, transform, INGEST_CHUNKSIZE)
+            rows = merge_incidents(raw_conn, self.cityid, columns, chunks, self.watermark, BLOCK_ENGINE == "postgis", types)
+            print("\t{} new incidents".format(rows))
+        else:
+            if INGEST_WORKERS > 1:
+                chunks = pd.read_csv(csv_file_path, chunksize=INGEST_CHUNKSIZE)
+                parallel_copy(self.db_uri, "incident", columns, chunks, transform, INGEST_WORKERS, self.set_block_index, (self.block_rows,), types)
+            elif STREAM_INGEST or BINARY_COPY:
+                chunks = read_chunks(csv_file_path, transform, INGEST_CHUNKSIZE)
+                copy_frames(raw_conn, "incident", columns, chunks, types=types)
+            else:
+                transform(pd.read_csv(csv_file_path)).to_csv(formatted_path, index=False)
+                self.add_formatted_data(formatted_path, "incident")
+            refresh_cube(raw_conn, self.cityid, self.watermark)
+            save_watermark(raw_conn, self.cityid)
+            raw_conn.commit()
+        raw_conn.close()
+
+    def set_block_index(self, rows):
+        """Build the block index from (id, wkb) rows. Also run once in every
+            ingest worker process."""
+        self.block_index = BlockIndex.from_wkb(rows)
+
+    def assign_blocks(self, incidents, x, y):
+        """Set blockid from the block index. With BLOCK_ENGINE=postgis blocks are
+            assigned in the database instead, so this only adds a placeholder
+            column that is left out of the COPY."""
+        if BLOCK_ENGINE == "postgis":
+            incidents.loc[:, "blockid"] = 0
+        else:
+            incidents.loc[:, "blockid"] = self.block_index.assign(x, y)
+        return incidents
+
+    def format_incidents(self, adapter, incidents):
+        """Format raw crime rows of a registered city as incident table rows."""
+        incidents = add_time_columns(incidents, adapter.date_column, adapter.date_format, adapter.hour_column)
+        if self.watermark is not None:
+            incidents = incidents.loc[incidents["datetime"] >= self.watermark].copy()
+        incidents, x, y = adapter.points(incidents)
+        if BINARY_COPY:
+            incidents["location"] = shapely.points(x, y)
+        incidents.loc[:,"crimetypeid"] = map_lookup(incidents[adapter.crime_column], self.crimetype_lookup, self.find_crimetypeid)
+        incidents.loc[:,"locdescid"] = map_lookup(incidents[adapter.locdesc_column], self.loctype_lookup, self.find_loctypeid)
+        incidents = self.assign_blocks(incidents, x, y)
+        incidents.loc[:, "cityid"] = self.cityid
+        incidents = incidents.loc[:,self.table_columns["incident"]]
+        incidents = incidents.dropna()
+        incidents.loc[:,"crimetypeid"] = incidents.loc[:,"crimetypeid"].astype(int)
+        incidents.loc[:,"locdescid"] = incidents.loc[:,"locdescid"].astype(int)
+        incidents.loc[:,"cityid"] = incidents.loc[:,"cityid"].astype(int)
+        incidents.loc[:,"blockid"] = incidents.loc[:,"blockid"].astype(int)
+        return incidents
+
+    def city_id(self, adapter):
+        """Id of the city row of a registered city."""
+        raw_conn = raw_connection(self.db_uri)
+        cursor = raw_conn.cursor()
+        cursor.execute("SELECT id FROM city WHERE location = ST_GeomFromEWKT(%s);", (adapter.location,))
+        cityid = cursor.fetchone()[0]
+        cursor.close()
+        raw_conn.rollback()
+        raw_conn.close()
+        return cityid
+
+    def ingest_city(self, name):
+        """Load one registered city: its city row, blocks and zipcodes on a full
+            load, then its incidents. Runs in its own process when CITY_WORKERS
+            is above 1."""
+        adapter = CITIES[name]
+        out_dir = os.path.join(self.formatted_dir, adapter.folder)
+        os.makedirs(out_dir, exist_ok=True)
+        if not INCREMENTAL_INGEST:
+            pd.DataFrame([adapter.city_row()], columns=self.table_columns["city"]).to_csv(os.path.join(out_dir, "cities.csv"), index=False)
+            self.add_formatted_data(os.path.join(out_dir, "cities.csv"), "city")
+            print(name, "city")
+        self.cityid = self.city_id(adapter)
+        if not INCREMENTAL_INGEST:
+            blocks = adapter.blocks()
+            blocks.insert(0, "cityid", self.cityid)
+            self.add_shapes(blocks, "block", os.path.join(out_dir, "blocks.csv"))
+            print(name, "blocks")
+            zipcodes = adapter.zipcode_shapes()
+            zipcodes.insert(0, "cityid", self.cityid)
+            self.add_shapes(zipcodes, "zipcodegeom", os.path.join(out_dir, "zipcodes.csv"))
+            print(name, "zipcodes")
+        if BLOCK_ENGINE == "python":
+            raw_conn = raw_connection(self.db_uri)
+            blocks = cached_shapes(raw_conn, "block", os.path.join(self.geometry_cache_dir, "block_{}.geoc".format(self.cityid)), "cityid = %s", (self.cityid,), GEOMETRY_CACHE_VERIFY)
+            raw_conn.close()
+            self.block_rows = blocks.rows()
+            self.set_block_index(self.block_rows)
+        print(name, "\tuploading incidents")
+        self.load_incidents(adapter.path(adapter.crimes_file), os.path.join(out_dir, "incident.csv"), partial(self.format_incidents, adapter))
+        print(name, "incidents")
@@ -0,0 +1,28 @@
+"""Write simplified block and zipcode GeoJSON of every city for the map."""
+
+from decouple import config, Csv
+from db import print_report, raw_connection
+from tiles import ZOOMS, write_tiles
+import time
+
+
+# Read DB URI
+DB_URI = config('DB_URI')
+
+# Where the GeoJSON goes, where simplified shapes are cached between runs,
+# and the zoom levels to simplify for
+TILE_DIR           = config('TILE_DIR', default='tiles')
+GEOMETRY_CACHE_DIR = config('GEOMETRY_CACHE_DIR', default='geometry_cache')
+TILE_ZOOMS         = config('TILE_ZOOMS', default=",".join(str(z) for z in ZOOMS), cast=Csv(int))
+
+RAW_CONN = raw_connection(DB_URI)
+cursor = RAW_CONN.cursor()
+cursor.execute("SELECT id FROM city ORDER BY id;")
+cityids = [row[0] for row in cursor.fetchall()]
+cursor.close()
+for cityid in cityids:
+    start = time.perf_counter()
+    paths = write_tiles(RAW_CONN, cityid, TILE_DIR, GEOMETRY_CACHE_DIR, TILE_ZOOMS)
+    print(cityid, "{} files in {:.2f}s".format(len(paths), time.perf_counter() - start))
+RAW_CONN.close()
+print_report()
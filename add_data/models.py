@@ -2,7 +2,7 @@
 
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import Column, BigInteger, Integer, String, DateTime, \
-    ForeignKey, Float, LargeBinary
+    ForeignKey, Float, LargeBinary, UniqueConstraint
 from sqlalchemy.orm import relationship
 from geoalchemy2 import Geometry
 
@@ -91,8 +91,67 @@ class LocationDescriptionType(BASE):
 
 class Job(BASE):
     """Job model for DB and redis. Has information on the status and result of
-        redis queue job."""
+        redis queue job. Result is a JSON summary, the output rows are kept
+        in jobchunk."""
     __tablename__ = 'job'
     id            = Column(BigInteger, primary_key=True)
     result        = Column(String, nullable=False)
     datetime      = Column(DateTime, nullable=False)
+    kind          = Column(String, nullable=True)
+    params        = Column(String, nullable=True)
+    status        = Column(String, nullable=True)
+    updated       = Column(DateTime, nullable=True)
+    chunks        = relationship("JobChunk", back_populates="job")
+
+
+class JobChunk(BASE):
+    """Job chunk model for DB. Has one CSV chunk of the output of a job, in
+        seq order, so callers can read results while the job runs."""
+    __tablename__ = 'jobchunk'
+    __table_args__ = (UniqueConstraint('jobid', 'seq'),)
+    id            = Column(BigInteger, primary_key=True)
+    jobid         = Column(BigInteger, ForeignKey('job.id'), nullable=False)
+    seq           = Column(Integer, nullable=False)
+    rows          = Column(Integer, nullable=False)
+    data          = Column(LargeBinary, nullable=False)
+    job           = relationship("Job", back_populates="chunks")
+
+
+class IngestState(BASE):
+    """Ingest state model for DB. Has the latest incident datetime loaded for
+        each city, used as the starting point of incremental loads."""
+    __tablename__ = 'ingeststate'
+    id            = Column(BigInteger, primary_key=True)
+    cityid        = Column(BigInteger, ForeignKey('city.id'), nullable=False, unique=True)
+    datetime      = Column(DateTime, nullable=False)
+
+
+class IncidentCube(BASE):
+    """Incident cube model for DB. Has the number of incidents of each crime
+        type per block and hour, kept up to date as incidents are loaded."""
+    __tablename__ = 'incidentcube'
+    __table_args__ = (UniqueConstraint('cityid', 'blockid', 'year', 'month', 'dow', 'hour', 'crimetypeid'),)
+    id            = Column(BigInteger, primary_key=True)
+    cityid        = Column(BigInteger, ForeignKey('city.id'), nullable=False)
+    blockid       = Column(BigInteger, ForeignKey('block.id'), nullable=False)
+    year          = Column(Integer, nullable=False)
+    month         = Column(Integer, nullable=False)
+    dow           = Column(Integer, nullable=False)
+    hour          = Column(Integer, nullable=False)
+    crimetypeid   = Column(BigInteger, ForeignKey('crimetype.id'), nullable=False)
+    count         = Column(Integer, nullable=False)
+
+
+class Prediction(BASE):
+    """Prediction model for DB. Has the (12, 7, 24) prediction of a block for
+        one model version and month as a predcodec blob, possibly quantized
+        and sparse. Runs write new rows, so readers of an earlier version or
+        month are not disturbed."""
+    __tablename__ = 'prediction'
+    __table_args__ = (UniqueConstraint('blockid', 'model_version', 'year', 'month'),)
+    id            = Column(BigInteger, primary_key=True)
+    blockid       = Column(BigInteger, ForeignKey('block.id'), nullable=False)
+    model_version = Column(String, nullable=False)
+    year          = Column(Integer, nullable=False)
+    month         = Column(Integer, nullable=False)
+    prediction    = Column(LargeBinary, nullable=False)
@@ -0,0 +1,32 @@
+"""Attach census populations to block shapes with keyed merges."""
+
+import pandas as pd
+
+
+def lookup_population(keys, pops, key_column, pop_column, label=None):
+    """Map each key to pops[pop_column] by a single indexed lookup. Keys
+        without a match get NaN and are printed when a label is given.
+        Duplicate keys in pops keep the first row."""
+    table = pops.drop_duplicates(key_column).set_index(key_column)[pop_column]
+    keys = pd.Series(keys).reset_index(drop=True)
+    populations = keys.map(table)
+    missing = keys[populations.isna()].tolist()
+    if label is not None and missing:
+        print("\tno population match for {} {}: {}".format(len(missing), label, ", ".join(str(x) for x in missing)))
+    return populations
+
+
+def tract_populations(boundaries, pops):
+    """Sum census block populations per tract from Chicago block boundary
+        features. Prints the tracts where no census block matched."""
+    blocks = pd.DataFrame({
+        "tract": [b["properties"]["tractce10"] for b in boundaries],
+        "geoid": [int(b["properties"]["geoid10"]) for b in boundaries],
+    })
+    blocks.loc[:, "population"] = lookup_population(blocks["geoid"], pops, "CENSUS BLOCK FULL", "TOTAL POPULATION").values
+    matched = blocks.groupby("tract")["population"].count()
+    missing = matched.index[matched == 0].tolist()
+    if missing:
+        print("\tno population match for {} tracts: {}".format(len(missing), ", ".join(missing)))
+    return blocks.groupby("tract")["population"].sum().astype(int).to_dict()
+
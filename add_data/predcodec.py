@@ -0,0 +1,158 @@
+"""Compact binary encoding of prediction arrays.
+
+Layout, little endian:
+    header   magic b"PRC1", uint8 dtype code, uint8 flags, uint8 ndim,
+             uint8 index width, float64 scale, float64 offset
+    shape    uint32[ndim]
+    dense    values[size]
+    sparse   uint32 count, indices[count] (uint16 or uint32), values[count]
+
+Stored values v decode to v * scale + offset. Floats are stored as is with
+scale 1 and offset 0; uint8/uint16 are quantized over [min(x, 0), max(x)],
+so zeros of non-negative data stay exactly zero. Sparse blobs only keep the
+positions whose stored value is not 0. Blobs without the magic are read as
+raw float64, the format written before this codec.
+"""
+
+import numpy as np
+import struct
+
+
+MAGIC = b"PRC1"
+HEADER = struct.Struct("<4sBBBBdd")
+# The header as a numpy record, to read the headers of many blobs at once
+HEADER_DTYPE = np.dtype([("magic", "S4"), ("code", "u1"), ("flags", "u1"), ("ndim", "u1"), ("index_width", "u1"), ("scale", "<f8"), ("offset", "<f8")])
+SPARSE = 1
+DTYPES = {
+    "float64": (1, np.dtype("<f8")),
+    "float32": (2, np.dtype("<f4")),
+    "float16": (3, np.dtype("<f2")),
+    "uint8": (4, np.dtype("u1")),
+    "uint16": (5, np.dtype("<u2")),
+}
+CODES = {code: dtype for code, dtype in DTYPES.values()}
+LEGACY_SHAPE = (12, 7, 24)
+
+
+def quantize(flat, dtype):
+    """Stored values, scale and offset of a float64 array for a dtype."""
+    if dtype.kind == "f":
+        return flat.astype(dtype), 1.0, 0.0
+    offset = min(float(flat.min()), 0.0) if flat.size else 0.0
+    span = float(flat.max()) - offset if flat.size else 0.0
+    scale = span / np.iinfo(dtype).max if span > 0 else 1.0
+    return np.rint((flat - offset) / scale).astype(dtype), scale, offset
+
+
+def error_bound(dtype, scale):
+    """Largest absolute decoding error of integer quantization with scale.
+        Float dtypes are bounded relative to each value instead, so 0."""
+    return scale / 2 if DTYPES[dtype][1].kind == "u" else 0.0
+
+
+def encode(x, dtype="float64", sparse=None):
+    """Encode an array. sparse=None picks whichever layout is smaller."""
+    code, dt = DTYPES[dtype]
+    x = np.asarray(x, dtype=np.float64)
+    values, scale, offset = quantize(x.ravel(), dt)
+    index_dt = np.dtype("<u2") if values.size <= 1 << 16 else np.dtype("<u4")
+    nonzero = np.flatnonzero(values)
+    if sparse is None:
+        sparse = 4 + len(nonzero) * (index_dt.itemsize + dt.itemsize) < values.size * dt.itemsize
+    parts = [HEADER.pack(MAGIC, code, SPARSE if sparse else 0, x.ndim, index_dt.itemsize, scale, offset), np.array(x.shape, dtype="<u4").tobytes()]
+    if sparse:
+        parts += [struct.pack("<I", len(nonzero)), nonzero.astype(index_dt).tobytes(), values[nonzero].tobytes()]
+    else:
+        parts.append(values.tobytes())
+    return b"".join(parts)
+
+
+def decode(data, out=None, shape=LEGACY_SHAPE):
+    """Decode a blob to float64, into out when given (e.g. a row of a larger
+        array). shape is only used for raw float64 blobs without a header."""
+    data = memoryview(data)
+    if bytes(data[:4]) != MAGIC:
+        values = np.frombuffer(data, dtype="<f8").reshape(shape)
+        if out is None:
+            return values.copy()
+        out[...] = values
+        return out
+    _, code, flags, ndim, index_width, scale, offset = HEADER.unpack_from(data, 0)
+    dt = CODES[code]
+    pos = HEADER.size
+    shape = tuple(int(n) for n in np.frombuffer(data, "<u4", ndim, pos))
+    pos += 4 * ndim
+    if out is None:
+        out = np.empty(shape)
+    flat = out.reshape(-1)
+    if flags & SPARSE:
+        count = struct.unpack_from("<I", data, pos)[0]
+        pos += 4
+        index = np.frombuffer(data, "<u{}".format(index_width), count, pos)
+        pos += index_width * count
+        flat[:] = offset
+        flat[index] = np.frombuffer(data, dt, count, pos) * scale + offset
+    else:
+        flat[:] = np.frombuffer(data, dt, flat.size, pos) * scale + offset
+    return out
+
+
+def _gather(buf, starts, width, dtype):
+    """(len(starts), width // itemsize) array of dtype read from buf at each
+        start, in one fancy index."""
+    return buf[starts[:, None] + np.arange(width)].view(dtype)
+
+
+def decode_many(blobs, shape=LEGACY_SHAPE):
+    """Decode blobs that all hold an array of shape into one
+        (len(blobs),) + shape float64 array.
+
+    The blobs are joined into one buffer and all headers read from it at
+    once. Blobs are then grouped by layout, dtype and index width, and each
+    group is decoded with one gather and one scatter for all its rows, so
+    the work per blob does not grow with the number of blobs.
+    """
+    size = int(np.prod(shape))
+    out = np.empty((len(blobs),) + tuple(shape))
+    if not len(blobs):
+        return out
+    flat = out.reshape(len(blobs), size)
+    lengths = np.array([len(b) for b in blobs], dtype=np.int64)
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    buf = np.frombuffer(b"".join(blobs), dtype=np.uint8)
+    coded = lengths >= HEADER.size
+    coded[coded] = _gather(buf, starts[coded], 4, "S4")[:, 0] == MAGIC
+    legacy = np.flatnonzero(~coded)
+    if len(legacy):
+        if (lengths[legacy] != size * 8).any():
+            raise ValueError("raw float64 prediction of the wrong size")
+        flat[legacy] = _gather(buf, starts[legacy], size * 8, "<f8")
+    rows = np.flatnonzero(coded)
+    if not len(rows):
+        return out
+    headers = _gather(buf, starts[rows], HEADER.size, HEADER_DTYPE)[:, 0]
+    if (headers["ndim"] != len(shape)).any():
+        raise ValueError("prediction of the wrong shape")
+    dims = _gather(buf, starts[rows] + HEADER.size, 4 * len(shape), "<u4")
+    if (dims != np.array(shape)).any():
+        raise ValueError("prediction of the wrong shape")
+    pos = starts[rows] + HEADER.size + 4 * len(shape)
+    groups = np.stack([headers["flags"] & SPARSE, headers["code"], headers["index_width"]], axis=1)
+    for sparse, code, index_width in np.unique(groups, axis=0):
+        member = (groups == (sparse, code, index_width)).all(axis=1)
+        dt = CODES[int(code)]
+        scale = headers["scale"][member]
+        offset = headers["offset"][member]
+        if not sparse:
+            flat[rows[member]] = _gather(buf, pos[member], size * dt.itemsize, dt) * scale[:, None] + offset[:, None]
+            continue
+        counts = _gather(buf, pos[member], 4, "<u4")[:, 0].astype(np.int64)
+        flat[rows[member]] = offset[:, None]
+        # position of every stored entry within its blob's index and value runs
+        nth = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        index_start = np.repeat(pos[member] + 4, counts)
+        value_start = index_start + np.repeat(counts * int(index_width), counts)
+        index = _gather(buf, index_start + nth * int(index_width), int(index_width), "<u{}".format(int(index_width)))[:, 0]
+        values = _gather(buf, value_start + nth * dt.itemsize, dt.itemsize, dt)[:, 0]
+        flat[np.repeat(rows[member], counts), index] = values * np.repeat(scale, counts) + np.repeat(offset, counts)
+    return out
@@ -0,0 +1,100 @@
+"""Write and read versioned block predictions in the prediction table."""
+
+from ingest import copy_frames
+from predcodec import decode_many, encode
+import numpy as np
+import pandas as pd
+
+
+PREDICTION_SHAPE = (12, 7, 24)
+PREDICTION_COLUMNS = ["blockid", "model_version", "year", "month", "prediction"]
+BLOCK_TYPES = {"id": "int8", "prediction": "bytea", "month": "int4", "year": "int4"}
+PREDICTION_TYPES = {"blockid": "int8", "model_version": "text", "year": "int4", "month": "int4", "prediction": "bytea"}
+
+
+def write_predictions(raw_conn, model_version, year, month, blockids, X, dtype="float64", sparse=None):
+    """Upsert one row of X per block for a model version and month, each
+        encoded with predcodec as dtype. Rows are sent by binary COPY into a
+        temporary table and merged with one INSERT ... ON CONFLICT, committed
+        together."""
+    predictions = pd.DataFrame({
+        "blockid": blockids,
+        "model_version": model_version,
+        "year": year,
+        "month": month,
+        "prediction": [encode(x.reshape(PREDICTION_SHAPE), dtype, sparse) for x in X],
+    })
+    cursor = raw_conn.cursor()
+    cursor.execute("CREATE TEMPORARY TABLE prediction_staging AS SELECT {} FROM prediction WITH NO DATA;".format(", ".join(PREDICTION_COLUMNS)))
+    copy_frames(raw_conn, "prediction_staging", PREDICTION_COLUMNS, [predictions], types=PREDICTION_TYPES)
+    cursor.execute("""
+        INSERT INTO prediction ({cols})
+        SELECT {cols} FROM prediction_staging
+        ON CONFLICT (blockid, model_version, year, month) DO UPDATE SET prediction = EXCLUDED.prediction;
+        DROP TABLE prediction_staging;
+    """.format(cols=", ".join(PREDICTION_COLUMNS)))
+    cursor.close()
+    raw_conn.commit()
+    return len(predictions)
+
+
+def update_blocks(raw_conn, year, month, blockids, X):
+    """Write raw float64 predictions to block.prediction, the single slot
+        older readers use, by binary COPY and one UPDATE ... FROM."""
+    predictions = pd.DataFrame({"id": blockids, "prediction": [x.astype(np.float64).tobytes() for x in X], "month": month, "year": year})
+    cursor = raw_conn.cursor()
+    cursor.execute("CREATE TEMPORARY TABLE block_predictions (id BIGINT PRIMARY KEY, prediction BYTEA, month INTEGER, year INTEGER);")
+    copy_frames(raw_conn, "block_predictions", ["id", "prediction", "month", "year"], [predictions], types=BLOCK_TYPES)
+    cursor.execute("""
+        UPDATE block
+        SET prediction = p.prediction, month = p.month, year = p.year
+        FROM block_predictions p
+        WHERE block.id = p.id;
+        DROP TABLE block_predictions;
+    """)
+    cursor.close()
+    raw_conn.commit()
+
+
+def latest_month(raw_conn, cityid, model_version):
+    """(year, month) of the latest predictions of a version for a city, or
+        None if there are none."""
+    cursor = raw_conn.cursor()
+    cursor.execute("""
+        SELECT p.year, p.month FROM prediction p
+        INNER JOIN block b ON b.id = p.blockid
+        WHERE b.cityid = %s AND p.model_version = %s
+        ORDER BY p.year DESC, p.month DESC LIMIT 1;
+    """, (cityid, model_version))
+    row = cursor.fetchone()
+    cursor.close()
+    return row
+
+
+def read_predictions(raw_conn, cityid, model_version, year=None, month=None):
+    """Predictions of every block of a city for a version and month, latest
+        month when none is given.
+
+    All rows come back from one query as raw bytea, with no hex round trip,
+    and are decoded together by predcodec.decode_many, one vectorized step
+    per dtype and layout.
+    Returns the block ids, ascending, and a (n_blocks, 12, 7, 24) float64
+    array in the same order.
+    """
+    if year is None or month is None:
+        latest = latest_month(raw_conn, cityid, model_version)
+        if latest is None:
+            return np.zeros(0, dtype=np.int64), np.zeros((0,) + PREDICTION_SHAPE)
+        year, month = latest
+    cursor = raw_conn.cursor()
+    cursor.execute("""
+        SELECT array_agg(p.blockid ORDER BY p.blockid), array_agg(p.prediction ORDER BY p.blockid)
+        FROM prediction p
+        INNER JOIN block b ON b.id = p.blockid
+        WHERE b.cityid = %s AND p.model_version = %s AND p.year = %s AND p.month = %s;
+    """, (cityid, model_version, year, month))
+    blockids, blobs = cursor.fetchone()
+    cursor.close()
+    if blockids is None:
+        return np.zeros(0, dtype=np.int64), np.zeros((0,) + PREDICTION_SHAPE)
+    return np.array(blockids, dtype=np.int64), decode_many(blobs, PREDICTION_SHAPE)
@@ -0,0 +1,232 @@
+"""Bound, prepared incident export queries and a result cache in front of them.
+
+A filter set is normalized into a hashable tuple first, so the same
+dashboard filters always give the same cache key and statement. Each
+combination of optional filters ("shape") gets its own server-side prepared
+statement, prepared once per connection and then only EXECUTEd with new
+parameters.
+"""
+
+from collections import OrderedDict
+import datetime
+import threading
+import time
+import pandas as pd
+
+
+OUTPUTS = [
+    "city.city", "city.state", "city.country", "incident.datetime", "incident.location", "crimetype.category",
+    "locdesctype.key1 AS location_key1", "locdesctype.key2 AS location_key2", "locdesctype.key3 AS location_key3",
+]
+COLUMNS = ["city", "state", "country", "datetime", "location", "category", "location_key1", "location_key2", "location_key3"]
+QUERY_BASE = """
+    SELECT {outputs}
+    FROM incident
+    INNER JOIN crimetype ON incident.crimetypeid = crimetype.id
+    INNER JOIN locdesctype ON incident.locdescid = locdesctype.id
+    INNER JOIN city ON incident.cityid = city.id
+    WHERE {where}
+""".format(outputs=", ".join(OUTPUTS), where="{where}")
+# Filters in parameter order: name, parameter types, condition with one
+# {} per parameter. The first three are always present.
+FILTERS = [
+    ("cityid", ["bigint"], "incident.cityid = {}"),
+    ("dates", ["timestamp", "timestamp"], "incident.datetime >= {} AND incident.datetime <= {}"),
+    ("hours", ["integer", "integer"], "incident.hour >= {} AND incident.hour <= {}"),
+    ("dotw", ["integer[]"], "incident.dow = ANY({})"),
+    ("crimetypes", ["text[]"], "crimetype.category = ANY({})"),
+    ("lockeys", ["text[]", "text[]", "text[]"], "(locdesctype.key1, locdesctype.key2, locdesctype.key3) IN (SELECT * FROM unnest({}, {}, {}))"),
+]
+DATE_FORMAT = "%m/%d/%Y"
+
+
+def split_list(value, cast=str):
+    """Sorted tuple of the comma separated values of a string, or of a list."""
+    if isinstance(value, str):
+        value = [x for x in value.split(",") if x != ""]
+    return tuple(sorted(set(cast(x) for x in value)))
+
+
+def normalize_filters(cityid, sdt, edt, stime=0, etime=24, dotw="", crimetypes="", locdesc1="", locdesc2="", locdesc3=""):
+    """Hashable filter set of one export request.
+
+    Dates are MM/DD/YYYY strings or dates, list filters comma separated
+    strings or lists. Lists are deduplicated and sorted and empty ones left
+    out, so equivalent requests normalize to the same tuple. Location keys
+    are only used when all three lists have the same length, as before.
+    """
+    if isinstance(sdt, str):
+        sdt = datetime.datetime.strptime(sdt, DATE_FORMAT)
+    if isinstance(edt, str):
+        edt = datetime.datetime.strptime(edt, DATE_FORMAT)
+    filters = [("cityid", int(cityid)), ("dates", sdt, edt), ("hours", int(stime), int(etime))]
+    dotw = split_list(dotw, int)
+    if dotw:
+        filters.append(("dotw", dotw))
+    crimetypes = split_list(crimetypes)
+    if crimetypes:
+        filters.append(("crimetypes", crimetypes))
+    keys = [[x for x in k.split(",")] if isinstance(k, str) else list(k) for k in (locdesc1, locdesc2, locdesc3)]
+    if all(k != [""] and k for k in keys) and len(keys[0]) == len(keys[1]) == len(keys[2]):
+        filters.append(("lockeys",) + tuple(zip(*sorted(set(zip(*keys))))))
+    return tuple(filters)
+
+
+def filter_params(filters):
+    """Parameter values of a normalized filter set, in statement order."""
+    params = []
+    for f in filters:
+        params += [list(v) if isinstance(v, tuple) else v for v in f[1:]]
+    return params
+
+
+def statement(filters, placeholder):
+    """SQL and prepared statement name of the shape of a filter set.
+        placeholder(i) gives the text of the i-th (0 based) parameter."""
+    present = set(f[0] for f in filters)
+    conditions = []
+    n = 0
+    for bit, (name, types, condition) in enumerate(FILTERS):
+        if name in present:
+            conditions.append(condition.format(*[placeholder(n + i) for i in range(len(types))]))
+            n += len(types)
+    shape = sum(1 << bit for bit, f in enumerate(FILTERS) if f[0] in present)
+    return QUERY_BASE.format(where=" AND ".join(conditions)), "incident_export_{}".format(shape)
+
+
+def parameter_types(filters):
+    """Declared parameter types of the statement of a filter set."""
+    present = set(f[0] for f in filters)
+    return [t for name, types, _ in FILTERS if name in present for t in types]
+
+
+def copy_query(cursor, filters):
+    """COPY (...) TO STDOUT WITH CSV HEADER of a filter set, with the
+        parameters bound by the driver. COPY cannot run a prepared
+        statement, so this is for streaming exports."""
+    sql, _ = statement(filters, lambda i: "%s")
+    return cursor.mogrify("COPY ({}) TO STDOUT WITH DELIMITER ',' CSV HEADER;".format(sql.strip()), filter_params(filters)).decode()
+
+
+def prepared_names(raw_conn):
+    """Names of the statements prepared on a connection's server session.
+        PREPAREs outlive transactions and pool checkouts, so the set is kept
+        in the pool's info dict of the connection, which is cleared when
+        the connection is replaced, and filled from pg_prepared_statements
+        the first time a connection is seen."""
+    info = getattr(raw_conn, "info", None)
+    if info is not None and "prepared_statements" in info:
+        return info["prepared_statements"]
+    cursor = raw_conn.cursor()
+    cursor.execute("SELECT name FROM pg_prepared_statements;")
+    names = set(row[0] for row in cursor.fetchall())
+    cursor.close()
+    if info is not None:
+        info["prepared_statements"] = names
+    return names
+
+
+class PreparedQueries:
+    """Incident exports on one raw connection through prepared statements,
+        prepared the first time their shape is used on the connection."""
+
+    def __init__(self, raw_conn):
+        self.raw_conn = raw_conn
+
+    def fetch(self, filters):
+        """DataFrame of the incidents of a normalized filter set, with the
+            location column as hex WKB like the COPY export. Ends the read
+            transaction."""
+        sql, name = statement(filters, lambda i: "${}".format(i + 1))
+        prepared = prepared_names(self.raw_conn)
+        cursor = self.raw_conn.cursor()
+        if name not in prepared:
+            cursor.execute("PREPARE {} ({}) AS {};".format(name, ", ".join(parameter_types(filters)), sql))
+            prepared.add(name)
+        params = filter_params(filters)
+        cursor.execute("EXECUTE {} ({});".format(name, ", ".join(["%s"] * len(params))), params)
+        rows = cursor.fetchall()
+        cursor.close()
+        self.raw_conn.rollback()
+        return pd.DataFrame.from_records(rows, columns=COLUMNS)
+
+
+class ResultCache:
+    """LRU cache of results with a time to live.
+
+    Entries are dropped when older than ttl seconds, and the least recently
+    used ones when there are more than maxsize entries or their sizes add up
+    to more than maxbytes. size(value) gives the size of an entry, the deep
+    memory usage of a DataFrame by default. Safe to share between threads.
+    """
+
+    def __init__(self, maxsize=128, ttl=300, maxbytes=256 * 1024 * 1024, size=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.size = size or (lambda df: int(df.memory_usage(deep=True).sum()))
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Cached value of key, or None when missing or expired."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() - entry[1] > self.ttl:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        """Store value under key and evict what no longer fits. A value
+            larger than maxbytes on its own is not stored."""
+        nbytes = self.size(value)
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            if nbytes > self.maxbytes:
+                return
+            self.entries[key] = (value, time.monotonic(), nbytes)
+            self.nbytes += nbytes
+            while len(self.entries) > self.maxsize or self.nbytes > self.maxbytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def get_or_compute(self, key, compute):
+        """Cached value of key, computed by compute() and stored on a miss."""
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """Counters and current size, e.g. for logging."""
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "entries": len(self.entries), "bytes": self.nbytes}
+
+    def _remove(self, key):
+        self.nbytes -= self.entries.pop(key)[2]
+
+
+def cached_fetch(queries, cache, filters, transform=None):
+    """Incidents of a normalized filter set from cache, or from the database
+        through queries (a PreparedQueries) and transform on a miss. Callers
+        must not modify the returned DataFrame, it is shared with the
+        cache."""
+    transform = transform or (lambda df: df)
+    return cache.get_or_compute(filters, lambda: transform(queries.fetch(filters)))
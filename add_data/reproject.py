@@ -0,0 +1,48 @@
+"""Batched reprojection of source shapes, cached next to the source file."""
+
+from pyproj import Transformer
+import numpy as np
+import shapely
+import os
+
+
+def project_geometries(geoms, src_crs, dst_crs):
+    """Reproject shapely geometries with one Transformer call over all of
+        their coordinates. Axis order is x/y (lon/lat) on both sides."""
+    geoms = np.array(geoms, dtype=object)
+    transformer = Transformer.from_crs(src_crs, dst_crs, always_xy=True)
+    coords = shapely.get_coordinates(geoms)
+    x, y = transformer.transform(coords[:, 0], coords[:, 1])
+    return shapely.set_coordinates(geoms, np.column_stack([x, y]))
+
+
+def _cache_path(path, dst_crs):
+    return "{}.{}.npz".format(os.path.splitext(path)[0], dst_crs.replace(":", "_").lower())
+
+
+def _cache_key(path, src_crs, dst_crs):
+    stat = os.stat(path)
+    return "{} {} {} {}".format(stat.st_size, stat.st_mtime_ns, src_crs, dst_crs)
+
+
+def projected_shapes(path, src_crs, dst_crs, read_shapes):
+    """Shapes of the file at path reprojected from src_crs to dst_crs.
+
+    read_shapes() returns the source shapes in file order. The projected
+    shapes are kept as WKB in a .npz beside the file and reused as long as
+    the file's size and mtime are unchanged.
+    """
+    cache = _cache_path(path, dst_crs)
+    key = _cache_key(path, src_crs, dst_crs)
+    if os.path.exists(cache):
+        with np.load(cache) as f:
+            if str(f["key"]) == key:
+                data, offsets = f["data"].tobytes(), f["offsets"]
+                return shapely.from_wkb([data[a:b] for a, b in zip(offsets[:-1], offsets[1:])])
+    geoms = project_geometries(read_shapes(), src_crs, dst_crs)
+    wkbs = shapely.to_wkb(geoms)
+    offsets = np.concatenate([[0], np.cumsum([len(w) for w in wkbs])]).astype(np.int64)
+    tmp = cache + ".tmp.npz"
+    np.savez(tmp, key=np.array(key), offsets=offsets, data=np.frombuffer(b"".join(wkbs), dtype=np.uint8))
+    os.replace(tmp, cache)
+    return geoms
@@ -0,0 +1,28 @@
+"""Map raw crime and location descriptions to taxonomy ids per distinct value."""
+
+import numpy as np
+import pandas as pd
+
+
+def compile_lookup(descriptions, resolve):
+    """Resolve every known description once into a {description: id} table.
+        resolve is the schema's own description -> id function."""
+    return {d: resolve(d) for d in descriptions}
+
+
+def map_lookup(values, table, resolve):
+    """Map a column of descriptions to ids through a compiled table. Each
+        distinct value is looked up once and broadcast back to its rows.
+        Values missing from the table are resolved and added to it. Ids
+        that resolve to None come back as NaN."""
+    codes, uniques = pd.factorize(values, use_na_sentinel=False)
+    ids = np.empty(len(uniques), dtype=float)
+    for i, u in enumerate(uniques):
+        if u in table:
+            found = table[u]
+        else:
+            found = resolve(u)
+            if u == u:
+                table[u] = found
+        ids[i] = np.nan if found is None else found
+    return pd.Series(ids[codes], index=values.index)
@@ -0,0 +1,35 @@
+"""Dense block x time arrays built from grouped incident rows."""
+
+import numpy as np
+import pandas as pd
+
+
+HOURS_PER_MONTH = 7 * 24
+
+
+def severity_tensor(df, start_year, start_month, months=12, value_column="severity"):
+    """Scatter grouped (blockid, year, month, dow, hour) rows into a
+        (blocks, months*7*24) float array in one assignment.
+
+    Column of a row is its month offset from start_year/start_month, then
+    dow, then hour. Blocks are numbered in order of first appearance in df.
+    Returns the block ids, in row order, and the array.
+    """
+    rows, blockids = pd.factorize(df["blockid"])
+    month = 12 * (df["year"].values.astype(np.int64) - start_year) + df["month"].values.astype(np.int64) - start_month - 1
+    cols = (month * 7 + df["dow"].values.astype(np.int64)) * 24 + df["hour"].values.astype(np.int64)
+    X = np.zeros((len(blockids), months * HOURS_PER_MONTH))
+    X[rows, cols] = df[value_column].values.astype(np.float64)
+    return np.asarray(blockids), X
+
+
+def _severity_tensor_loop(df, start_year, start_month):
+    """The per-row loop allblocks.py used before severity_tensor, kept as
+        the reference the tests and bench.py compare it with."""
+    block_ids = {}
+    for ind, blockid in enumerate(df["blockid"].unique()):
+        block_ids[blockid] = ind
+    X = np.zeros((len(block_ids), 12*7*24))
+    for i in df.index.values:
+        X[block_ids[df.loc[i,"blockid"]], ((12 * (df.loc[i,"year"] - start_year) + df.loc[i,"month"] - start_month - 1) * 7 + (df.loc[i,"dow"])) * 24 + df.loc[i,"hour"]] = float(df.loc[i,"severity"])
+    return list(block_ids), X
@@ -0,0 +1,39 @@
+"""severity_tensor against the per-row loop allblocks.py used before it."""
+
+from decimal import Decimal
+from tensors import _severity_tensor_loop, severity_tensor
+import numpy as np
+import pandas as pd
+
+
+def grouped_rows(n, start_year, start_month, seed=0):
+    """Grouped incident rows over the 12 months from start_year/start_month,
+        with Decimal severities as they come from the database."""
+    rng = np.random.default_rng(seed)
+    month = rng.integers(0, 12, n) + start_month
+    return pd.DataFrame({
+        "blockid": rng.integers(1, 50, n),
+        "year": start_year + (month > 12),
+        "month": (month - 1) % 12 + 1,
+        "dow": rng.integers(0, 7, n),
+        "hour": rng.integers(0, 24, n),
+        "severity": [Decimal(str(x)) for x in rng.uniform(0, 5, n).round(6)],
+    }).drop_duplicates(["blockid", "year", "month", "dow", "hour"]).reset_index(drop=True)
+
+
+def test_matches_reference_loop():
+    df = grouped_rows(2000, 2018, 3)
+    ids, X = _severity_tensor_loop(df, 2018, 3)
+    new_ids, new_X = severity_tensor(df, 2018, 3)
+    assert list(new_ids) == ids
+    assert np.array_equal(new_X, X)
+
+
+def test_year_boundary_and_empty_frame():
+    df = pd.DataFrame({"blockid": [7, 3], "year": [2018, 2019], "month": [12, 1], "dow": [0, 6], "hour": [0, 23], "severity": [Decimal("1.5"), Decimal("0.2")]})
+    ids, X = _severity_tensor_loop(df, 2018, 11)
+    new_ids, new_X = severity_tensor(df, 2018, 11)
+    assert list(new_ids) == ids == [7, 3]
+    assert np.array_equal(new_X, X)
+    empty_ids, empty_X = severity_tensor(df.iloc[:0], 2018, 11)
+    assert len(empty_ids) == 0 and empty_X.shape == (0, 12*7*24)
@@ -0,0 +1,126 @@
+"""Simplified block and zipcode shapes for the map, one GeoJSON file per city,
+table and zoom level.
+
+Shapes are simplified together as a coverage, so neighbouring blocks keep
+sharing their edges, with a tolerance of half a screen pixel at the zoom,
+then snapped to a grid of a tenth of a pixel and written with just enough
+decimals for that grid. The simplified shapes of each zoom are kept in a
+GeometryCache with the stamp of the source shapes and only recomputed when
+the shapes in the database change. The GeoJSON is written again on every
+run, with the current per-block aggregates.
+"""
+
+from geomcache import GeometryCache, cached_shapes, write_cache
+from shapely.geometry import mapping
+import numpy as np
+import shapely
+import json
+import math
+import os
+
+
+TILE_SIZE = 256
+ZOOMS = (8, 10, 12, 14)
+
+
+def pixel_degrees(zoom):
+    """Width of a screen pixel in degrees of longitude at a web map zoom."""
+    return 360.0 / (TILE_SIZE * 2 ** zoom)
+
+
+def simplify_shapes(geoms, zoom):
+    """Shapes simplified for a zoom and snapped to its grid. Shapes that
+        collapse at this zoom come back empty. Falls back to simplifying
+        each shape on its own with shapely before 2.1, which can open slivers
+        between neighbours."""
+    tolerance = pixel_degrees(zoom) / 2
+    geoms = np.asarray(geoms, dtype=object)
+    if hasattr(shapely, "coverage_simplify"):
+        simplified = shapely.coverage_simplify(geoms, tolerance)
+    else:
+        simplified = shapely.simplify(geoms, tolerance, preserve_topology=True)
+    return shapely.set_precision(simplified, pixel_degrees(zoom) / 10)
+
+
+def decimals(zoom):
+    """Decimals needed to write coordinates snapped for a zoom."""
+    return max(0, math.ceil(-math.log10(pixel_degrees(zoom) / 10)))
+
+
+def feature_collection(ids, geoms, properties, digits):
+    """GeoJSON FeatureCollection text of shapes with coordinates rounded to
+        digits. properties maps an id to its feature properties. Empty
+        shapes are left out."""
+    geoms = np.asarray(geoms, dtype=object)
+    keep = ~shapely.is_empty(geoms)
+    rounded = shapely.transform(geoms[keep], lambda xy: np.round(xy, digits))
+    features = [
+        {"type": "Feature", "id": int(i), "geometry": mapping(g), "properties": properties.get(int(i), {})}
+        for i, g in zip(np.asarray(ids)[keep], rounded)
+    ]
+    return json.dumps({"type": "FeatureCollection", "features": features}, separators=(",", ":"))
+
+
+def simplified_shapes(source, path, zoom):
+    """GeometryCache at path of the shapes of source, a GeometryCache,
+        simplified for a zoom. The file is reused while it has the stamp of
+        source."""
+    if os.path.exists(path):
+        try:
+            cache = GeometryCache(path)
+        except ValueError:
+            cache = None
+        if cache is not None and cache.stamp == source.stamp:
+            return cache
+    geoms = simplify_shapes(source.geometries(), zoom)
+    write_cache(path, list(zip(source.ids.tolist(), shapely.to_wkb(geoms))), source.stamp)
+    return GeometryCache(path)
+
+
+def block_aggregates(raw_conn, cityid, months=12):
+    """Population, incident count and severity sum of every block of a city
+        over the last months months in incidentcube, by block id."""
+    cursor = raw_conn.cursor()
+    cursor.execute("""
+        SELECT b.id, b.population, COALESCE(SUM(c.count), 0), COALESCE(SUM(c.count * t.severity), 0)
+        FROM block b
+        LEFT JOIN incidentcube c ON c.blockid = b.id
+            AND c.year * 12 + c.month > (SELECT MAX(year * 12 + month) FROM incidentcube WHERE cityid = %(cityid)s) - %(months)s
+        LEFT JOIN crimetype t ON t.id = c.crimetypeid
+        WHERE b.cityid = %(cityid)s
+        GROUP BY b.id, b.population;
+    """, {"cityid": cityid, "months": months})
+    rows = cursor.fetchall()
+    cursor.close()
+    return {int(i): {"population": population, "incidents": int(incidents), "severity": float(severity)} for i, population, incidents, severity in rows}
+
+
+def zipcode_properties(raw_conn, cityid):
+    """Zipcode of every zipcodegeom row of a city, by id."""
+    cursor = raw_conn.cursor()
+    cursor.execute("SELECT id, zipcode FROM zipcodegeom WHERE cityid = %s;", (cityid,))
+    rows = cursor.fetchall()
+    cursor.close()
+    return {int(i): {"zipcode": zipcode} for i, zipcode in rows}
+
+
+def write_tiles(raw_conn, cityid, out_dir, cache_dir, zooms=ZOOMS):
+    """Write block_<city>_z<zoom>.geojson with block aggregates and
+        zipcodegeom_<city>_z<zoom>.geojson for every zoom. Source and
+        simplified shapes are cached in cache_dir. Returns the paths
+        written."""
+    os.makedirs(out_dir, exist_ok=True)
+    properties = {"block": block_aggregates(raw_conn, cityid), "zipcodegeom": zipcode_properties(raw_conn, cityid)}
+    raw_conn.rollback()
+    paths = []
+    for table in ["block", "zipcodegeom"]:
+        source = cached_shapes(raw_conn, table, os.path.join(cache_dir, "{}_{}.geoc".format(table, cityid)), "cityid = %s", (cityid,))
+        for zoom in zooms:
+            cache = simplified_shapes(source, os.path.join(cache_dir, "{}_{}_z{}.geoc".format(table, cityid, zoom)), zoom)
+            path = os.path.join(out_dir, "{}_{}_z{}.geojson".format(table, cityid, zoom))
+            with open(path + ".tmp", "w") as f:
+                f.write(feature_collection(cache.ids, cache.geometries(), properties[table], decimals(zoom)))
+            os.replace(path + ".tmp", path)
+            paths.append(path)
+    raw_conn.rollback()
+    return paths
@@ -0,0 +1,58 @@
+"""Vectorized column transforms shared by the city incident loaders."""
+
+import numpy as np
+import pandas as pd
+import shapely
+
+
+# 2D point WKB: byte order, geometry type, x, y
+POINT_WKB = np.dtype([("order", "u1"), ("type", "<u4"), ("x", "<f8"), ("y", "<f8")])
+
+
+def point_wkt(x, y):
+    """Build "POINT(x y)" strings from two float columns."""
+    return "POINT(" + x.astype(float).astype(str) + " " + y.astype(float).astype(str) + ")"
+
+
+def paren_point_wkt(locations):
+    """Turn "(a, b)" location strings into "POINT(a b)" strings."""
+    return "POINT" + locations.astype(str).str.replace(",", "", regex=False)
+
+
+def add_time_columns(incidents, date_column, date_format, hour_column=None):
+    """Parse date_column once with an explicit format and add the datetime,
+        hour, dow, month and year columns. hour is taken from hour_column
+        instead when the source keeps the time separately."""
+    dt = pd.to_datetime(incidents[date_column], format=date_format, exact=False)
+    incidents.loc[:, "datetime"] = dt
+    if hour_column is None:
+        incidents.loc[:, "hour"] = dt.dt.hour
+    else:
+        incidents.loc[:, "hour"] = incidents[hour_column]
+    incidents.loc[:, "dow"] = dt.dt.dayofweek
+    incidents.loc[:, "month"] = dt.dt.month
+    incidents.loc[:, "year"] = dt.dt.year
+    return incidents
+
+
+def wkb_hex_points(locations):
+    """(n, 2) x/y array of hex WKB points, as geometry columns come out of
+        COPY. Little endian 2D points without SRID are decoded in one
+        structured view over the joined bytes; any other row goes through
+        shapely."""
+    locations = pd.Series(locations).astype(str)
+    xy = np.full((len(locations), 2), np.nan)
+    fixed = (locations.str.len() == 2 * POINT_WKB.itemsize).to_numpy(copy=True)
+    locations = locations.values
+    if fixed.any():
+        points = np.frombuffer(bytes.fromhex("".join(locations[fixed])), dtype=POINT_WKB)
+        plain = (points["order"] == 1) & (points["type"] == 1)
+        rows = np.flatnonzero(fixed)[plain]
+        xy[rows, 0] = points["x"][plain]
+        xy[rows, 1] = points["y"][plain]
+        fixed[np.flatnonzero(fixed)[~plain]] = False
+    if not fixed.all():
+        geoms = shapely.from_wkb(locations[~fixed])
+        xy[~fixed, 0] = shapely.get_x(geoms)
+        xy[~fixed, 1] = shapely.get_y(geoms)
+    return xy
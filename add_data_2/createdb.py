@@ -1,95 +1,73 @@
 """Create DB tables and input rows for tables."""
 
-from sqlalchemy import create_engine, func, text
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.schema import DropTable
 from sqlalchemy.ext.compiler import compiles
 from decouple import config
-from functools import partial
-from shapely import wkb, wkt
-from shapely.geometry import shape
-from shapely.geometry.multipolygon import MultiPolygon
-from shapely.ops import transform
-import shapefile
-import pyproj
-import geojson
 import pandas as pd
 from models import *
-import json
-import datetime
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "add_data"))
+from db import engine
+from loader import INCREMENTAL_INGEST, CityLoader
 
 
 # Connect to DB
 DB_URI  = config('DB_URI')
-ENGINE  = create_engine(DB_URI)
+ENGINE  = engine(DB_URI)
 Session = sessionmaker(bind=ENGINE)
 SESSION = Session()
 
-block_dict = {}
+# Where formatted CSVs and cached block shapes go
+FORMATTED_DIR = 'ALL_DATA'
+
 loctype_dict = {}
 crimetype_dict = {}
-locgroup_dict = {}
-crimeppo_dict = {}
-crimevio_dict = {}
+
+TABLE_COLUMNS = {
+    "city": ["city", "state", "country", "location"],
+    "block": ["cityid", "shape", "population"],
+    "zipcodegeom": ["cityid", "zipcode", "shape"],
+    "incident": ["crimetypeid", "locdescid", "cityid", "blockid", "location", "datetime", "hour", "dow", "month", "year"],
+    "crimetype": ["ppo", "violence"],
+    "locdesctype": ["locgroup"]
+}
+
+INDEXES = [
+    ("incident_block_idx", "incident (blockid)"),
+    ("incident_city_idx", "incident (cityid)"),
+    ("incident_citydatetime_idx", "incident (cityid, datetime)"),
+    ("incident_cityblock_idx", "incident (cityid, blockid)"),
+    ("incident_date_idx", "incident (month, year)"),
+    ("incident_dow_idx", "incident (dow)"),
+    ("incident_time_idx", "incident (hour)"),
+    ("incident_crimetype_idx", "incident (crimetypeid)"),
+    ("incident_locdesc_idx", "incident (locdescid)"),
+    ("incidentcube_citydate_idx", "incidentcube (cityid, year, month)"),
+    ("zipcodegeom_zipcode_idx", "zipcodegeom (zipcode)"),
+    ("city_city_idx", "city (city)"),
+    ("city_state_idx", "city (state)"),
+    ("city_country_idx", "city (country)"),
+    ("loc_group_idx", "locdesctype (locgroup)"),
+    ("crime_ppo_idx", "crimetype (ppo)"),
+    ("crime_viol_idx", "crimetype (violence)"),
+    ("crime_allcol_idx", "crimetype (ppo, violence)"),
+]
+
 
 @compiles(DropTable, "postgresql")
 def _compile_drop_table(element, compiler, **kwargs):
     return compiler.visit_drop_table(element) + " CASCADE"
 
 
-def reset_tables():
-    """Reset DB tables."""
-    BASE.metadata.drop_all(bind=ENGINE)
-    BASE.metadata.create_all(bind=ENGINE)
-
-def create_indexes():
-    SESSION.execute(text("CREATE INDEX incident_block_idx ON incident (blockid);"))
-    SESSION.execute(text("CREATE INDEX incident_city_idx ON incident (cityid);"))
-    SESSION.execute(text("CREATE INDEX incident_cityblock_idx ON incident (cityid, blockid);"))
-    SESSION.execute(text("CREATE INDEX incident_date_idx ON incident (month, year);"))
-    SESSION.execute(text("CREATE INDEX incident_dow_idx ON incident (dow);"))
-    SESSION.execute(text("CREATE INDEX incident_time_idx ON incident (hour);"))
-    SESSION.execute(text("CREATE INDEX incident_crimetype_idx ON incident (crimetypeid);"))
-    SESSION.execute(text("CREATE INDEX incident_locdesc_idx ON incident (locdescid);"))
-    SESSION.execute(text("CREATE INDEX zipcodegeom_zipcode_idx ON zipcodegeom (zipcode);"))
-    SESSION.execute(text("CREATE INDEX city_city_idx ON city (city);"))
-    SESSION.execute(text("CREATE INDEX city_state_idx ON city (state);"))
-    SESSION.execute(text("CREATE INDEX city_country_idx ON city (country);"))
-    SESSION.execute(text("CREATE INDEX loc_group_idx ON locdestype (locgroup);"))
-    SESSION.execute(text("CREATE INDEX crime_ppo_idx ON crimetype (ppo);"))
-    SESSION.execute(text("CREATE INDEX crime_viol_idx ON crimetype (violence);"))
-    SESSION.execute(text("CREATE INDEX crime_allcol_idx ON crimetype (ppo, violence);"))
-    SESSION.commit()
-
-def add_formatted_data(csv_file_path, table_type):
-    tables = {
-        "city": ["city", "state", "country", "location"],
-        "block": ["cityid", "shape", "population"],
-        "zipcodegeom": ["cityid", "zipcode", "shape"],
-        "incident": ["crimetypeid", "locdescid", "cityid", "blockid", "location", "datetime", "hour", "dow", "month", "year"],
-        "crimetype": ["ppo", "violence"],
-        "locdesctype": ["locgroup"]
-    }
-    with open(csv_file_path, 'r') as f:
-        RAW_CONN = create_engine(DB_URI).raw_connection()
-        cursor = RAW_CONN.cursor()
-        cmd = """COPY {}({}) FROM STDIN DELIMITER ',' CSV HEADER;"""
-        cmd = cmd.format(table_type, ",".join(tables[table_type]))
-        cursor.copy_expert(cmd, f)
-        RAW_CONN.commit()
-
 def find_crimetypeid(x):
-    return crimetype_dict.get(tuple(CRIME_DICT.get(CRIMETYPE_DICT.get(x, ["OTHER OFFENSE"]), ("NON_VIOLENT", "OTHER"))))
+    return crimetype_dict.get(tuple(CRIME_DICT.get(CRIMETYPE_DICT.get(x, "OTHER OFFENSE"), ("NON_VIOLENT", "OTHER"))))
 
 def find_loctypeid(x):
     return loctype_dict.get(LOCATION_GROUP_DICT.get(tuple(LOCATION_DICT.get(x, ["OTHER", "OTHER", "OTHER"])), "OTHER"))
 
-def find_blockid(x):
-    geom = wkt.loads(x)
-    for k in block_dict:
-        if block_dict[k].contains(geom):
-            return k
-    return None
 
 location_cat = [
     ["INDOOR", "RESIDENTIAL", "APARTMENT"],
@@ -274,186 +252,27 @@ for k in rev_crime_personal_property_dict:
             CRIME_DICT[i[0]] = ["NON_VIOLENT", k]
 
 
-reset_tables()
-# create_indexes()
-print("reset")
-
-
-pd.DataFrame(location_group, columns=["locgroup"]).to_csv("ALL_DATA/locations.csv", index=False)
-add_formatted_data("ALL_DATA/locations.csv", "locdesctype")
-print("locdesc")
-
-
-pd.DataFrame(crime_all, columns=["ppo", "violence"]).to_csv("ALL_DATA/crimetypes.csv", index=False)
-add_formatted_data("ALL_DATA/crimetypes.csv", "crimetype")
-print("crimetype")
-
-
-pd.DataFrame([["CHICAGO", "ILLINOIS", "UNITED STATES OF AMERICA", "POINT(41.8781 -87.6298)"]], columns=["city", "state", "country", "location"]).to_csv("ALL_DATA/Chicago_Data/cities.csv", index=False)
-add_formatted_data("ALL_DATA/Chicago_Data/cities.csv", "city")
-print("city")
-
-cityid = SESSION.query(City).filter(City.location == "POINT(41.8781 -87.6298)").one().id
-
-
-with open("../add_data/Chicago_Data/boundaries.json", "r") as fp:
-    boundaries = json.load(fp)["features"]
-with open("../add_data/Chicago_Data/boundaries_tracts.json", "r") as fp:
-    boundaries_tracts = json.load(fp)["features"]
-pops = pd.read_csv("../add_data/Chicago_Data/populations.csv")
-popu = {}
-for shape_i in boundaries:
-    if shape_i["properties"]["tractce10"] not in popu:
-        popu[shape_i["properties"]["tractce10"]] = 0
-    try:
-        popu[shape_i["properties"]["tractce10"]] += int(pops.loc[pops["CENSUS BLOCK FULL"]==int(shape_i["properties"]["geoid10"]),"TOTAL POPULATION"].values[0])
-    except:
-        pass
-shapes = []
-for shape_i in boundaries_tracts:
-    geo = geojson.loads(json.dumps(shape_i["geometry"]))
-    if geo["type"] != "MultiPolygon":
-        str_poly = MultiPolygon([shape(geo)]).wkt
-    else:
-        str_poly = shape(geo).wkt
-    shapes.append([cityid, str_poly, popu[shape_i["properties"]["tractce10"]]])
-pd.DataFrame(shapes, columns=["cityid", "shape", "population"]).to_csv("ALL_DATA/Chicago_Data/blocks.csv", index=False)
-add_formatted_data("ALL_DATA/Chicago_Data/blocks.csv", "block")
-print("blocks")
-
-
-zipcodes_list = [60007, 60018, 60068, 60106, 60131, 60176, 60601, 60602, 60603, 60604, 60605, 60606, 60607, 60608, 60609, 60610, 60611, 60612, 60613, 60614, 60615, 60616, 60617, 60618, 60619, 60620, 60621, 60622, 60623, 60624, 60625, 60626, 60628, 60629, 60630, 60631, 60632, 60633, 60634, 60636, 60637, 60638, 60639, 60640, 60641, 60642, 60643, 60644, 60645, 60646, 60647, 60649, 60651, 60652, 60653, 60654, 60655, 60656, 60657, 60659, 60660, 60661, 60706, 60707, 60714, 60804, 60827]
-zipcodes_list = [str(x) for x in zipcodes_list]
-with open("../add_data/Chicago_Data/zipcodes.json", "r") as fp:
-    zipcodes = json.load(fp)["features"]
-rows = []
-for i, zc in enumerate(zipcodes):
-    if zc["properties"]["ZCTA5CE10"] in zipcodes_list:
-        geo = geojson.loads(json.dumps(shape_i["geometry"]))
-        if geo["type"] != "MultiPolygon":
-            str_poly = MultiPolygon([shape(geo)]).wkt
-        else:
-            str_poly = shape(geo).wkt
-        rows.append([cityid, zc["properties"]["ZCTA5CE10"], str_poly])
-pd.DataFrame(rows, columns=["cityid", "zipcode", "shape"]).to_csv("ALL_DATA/Chicago_Data/zipcodes.csv", index=False)
-add_formatted_data("ALL_DATA/Chicago_Data/zipcodes.csv", "zipcodegeom")
-print("zipcodes")
-
-incidents = pd.read_csv("../add_data/Chicago_Data/crimes.csv")
-incidents.loc[:,"location"] = incidents[["Longitude", "Latitude"]].apply(lambda x: "POINT({})".format(" ".join([str(y) for y in x])), axis=1)
-crimetypes = SESSION.query(CrimeType).all()
-crimetype_dict = {}
-for c in crimetypes:
-    crimetype_dict[(c.violence, c.ppo)] = c.id
-incidents.loc[:,"crimetypeid"] = incidents["Primary Type"].apply(find_crimetypeid)
-loctypes = SESSION.query(LocationDescriptionType).all()
-loctype_dict = {}
-for c in loctypes:
-    loctype_dict[c.locgroup] = c.id
-incidents.loc[:,"locdescid"] = incidents["Location Description"].apply(find_loctypeid)
-blocks = SESSION.query(Blocks).all()
-block_dict = {}
-for b in blocks:
-    block_dict[b.id] = wkb.loads(b.shape.data.tobytes())
-incidents.loc[:,"blockid"] = incidents["location"].apply(find_blockid)
-incidents.loc[:, "datetime"] = pd.to_datetime(incidents["Date"])
-incidents.loc[:, "hour"] = incidents["datetime"].apply(lambda x: x.hour)
-incidents.loc[:, "dow"] = incidents["datetime"].apply(lambda x: x.weekday())
-incidents.loc[:, "month"] = incidents["datetime"].apply(lambda x: x.month)
-incidents.loc[:, "year"] = incidents["datetime"].apply(lambda x: x.year)
-incidents.loc[:, "cityid"] = cityid
-incidents = incidents.loc[:,["crimetypeid", "locdescid", "cityid", "blockid", "location", "datetime", "hour", "dow", "month", "year"]]
-incidents = incidents.dropna()
-incidents.loc[:,"crimetypeid"] = incidents.loc[:,"crimetypeid"].astype(int)
-incidents.loc[:,"locdescid"] = incidents.loc[:,"locdescid"].astype(int)
-incidents.loc[:,"cityid"] = incidents.loc[:,"cityid"].astype(int)
-incidents.loc[:,"blockid"] = incidents.loc[:,"blockid"].astype(int)
-incidents.to_csv("ALL_DATA/Chicago_Data/incident.csv", index=False)
-print("\tuploading incidents")
-add_formatted_data("ALL_DATA/Chicago_Data/incident.csv", "incident")
-print("incidents")
-
-
-pd.DataFrame([["LOS ANGELES", "CALIFORNIA", "UNITED STATES OF AMERICA", "POINT(34.0522 -118.2437)"]], columns=["city", "state", "country", "location"]).to_csv("ALL_DATA/LA_Data/cities.csv", index=False)
-add_formatted_data("ALL_DATA/LA_Data/cities.csv", "city")
-print("city")
-
-
-cityid = SESSION.query(City).filter(City.location == "POINT(34.0522 -118.2437)").one().id
-
-
-src = shapefile.Reader('../add_data/LA_data/tracts.shp')
-project = partial(
-    pyproj.transform,
-    pyproj.Proj(init='ESRI:102645'), # source coordinate system
-    pyproj.Proj(init='EPSG:4326')
-)
-pops = pd.read_csv("../add_data/LA_data/population.csv")
-records = src.records()
-rows = []
-for ind, rec in enumerate(src.shapeRecords()):
-    rows.append([cityid, MultiPolygon([(transform(project, shape(json.loads(json.dumps(rec.shape.__geo_interface__)))))]).wkt, records[ind][0]])
-blocks = pd.DataFrame(rows, columns=["cityid", "shape", "population"])
-blocks.loc[:, "population"] = blocks["population"].apply(lambda x: pops.loc[pops["OBJECTID"] == x, "POP"].values[0] if x in pops["OBJECTID"].values else None)
-blocks = blocks.dropna()
-blocks.loc[:, "population"] = blocks.loc[:, "population"].astype(int)
-blocks.to_csv("ALL_DATA/LA_Data/blocks.csv", index=False)
-add_formatted_data("ALL_DATA/LA_Data/blocks.csv", "block")
-print("blocks")
-
-
-zipcodes_list = [90895,91001,91006,91007,91011,91010,91016,91020,91017,93510,91023,91024,91030,91040,91043,91042,91101,91103,91105,93534,91104,93532,91107,93536,91106,93535,91108,93543,93544,91123,93551,93550,93553,93552,91182,93563,93590,91189,91202,91201,93591,91204,91203,91206,91205,91208,91207,91210,91214,91302,91301,91304,91303,91306,91307,91310,92397,91311,91316,91321,91325,91324,91326,91331,91330,91335,91340,91343,91342,91345,91344,91350,91346,91352,91351,91354,91356,91355,91357,91361,91364,91367,91365,91381,91383,91384,91387,91390,91402,91401,91404,91403,91406,91405,91411,91423,91436,91495,91501,91502,91505,91504,91506,91602,91601,91604,91606,91605,91608,91607,91614,91706,91702,91711,91722,91724,91723,91732,91731,91733,91735,91740,91741,91745,91744,91747,91746,91748,90002,90001,91750,91755,90004,90003,91754,90006,90005,90008,91759,90007,90010,90012,91765,90011,90014,91767,91766,90013,90016,90015,91768,90018,91770,90017,90020,91773,91772,90019,90022,91776,90021,91775,91780,90024,91778,90023,90026,90025,90028,90027,91790,90029,91789,90032,91792,91791,90031,90034,91793,90033,90036,90035,90038,91801,90037,90040,91803,90039,90042,90041,90044,90043,90046,90045,90048,90047,90049,90052,90056,90058,90057,90060,90059,90062,90061,90064,90063,90066,90065,90068,90067,90069,90071,90074,90077,91008,90084,90089,90095,90094,90096,90201,90189,90211,90210,90212,90221,90220,90222,90230,90232,90241,90240,90245,90242,90248,90247,90250,90249,90254,90260,90255,90262,90264,90263,90266,90265,90270,90274,90272,90277,90275,90280,90278,90291,90290,90293,90292,90295,90301,90296,90303,90302,90305,90304,90402,90401,90404,90403,90406,93243,90405,90501,90503,90502,90505,90504,90508,90601,90603,90602,90605,90604,90606,90631,90639,90638,90650,90640,90660,90670,90702,90701,90704,90703,90706,90710,90713,90712,90715,90717,90716,90731,90723,90733,90732,90745,90744,90747,90746,90755,90803,90802,90805,90804,90807,90806,90808,90813,90810,90815,90814,90840]
-zipcodes_list = [str(x) for x in zipcodes_list]
-with open("../add_data/LA_data/zipcodes.json", "r") as fp:
-    zipcodes = json.load(fp)["features"]
-rows = []
-for i, zc in enumerate(zipcodes):
-    if zc["properties"]["ZCTA5CE10"] in zipcodes_list:
-        geo = geojson.loads(json.dumps(shape_i["geometry"]))
-        if geo["type"] != "MultiPolygon":
-            str_poly = MultiPolygon([shape(geo)]).wkt
-        else:
-            str_poly = shape(geo).wkt
-        rows.append([cityid, zc["properties"]["ZCTA5CE10"], str_poly])
-pd.DataFrame(rows, columns=["cityid", "zipcode", "shape"]).to_csv("ALL_DATA/LA_Data/zipcodes.csv", index=False)
-add_formatted_data("ALL_DATA/LA_Data/zipcodes.csv", "zipcodegeom")
-print("zipcodes")
-
-
-incidents = pd.read_csv("../add_data/LA_data/crimes.csv")
-incidents = incidents.dropna(subset=["Location "])
-incidents.loc[:,"location"] = incidents["Location "].astype(str).apply(lambda x: x if x != "(0, 0)" else None)
-incidents = incidents.dropna(subset=["location"])
-incidents.loc[:,"location"] = incidents.loc[:,"location"].apply(lambda x: "POINT{}".format("".join(x.split(","))))
+LOADER = CityLoader(DB_URI, BASE.metadata, TABLE_COLUMNS, INDEXES, FORMATTED_DIR)
+LOADER.prepare()
+if not INCREMENTAL_INGEST:
+    pd.DataFrame(location_group, columns=["locgroup"]).to_csv("ALL_DATA/locations.csv", index=False)
+    LOADER.add_formatted_data("ALL_DATA/locations.csv", "locdesctype")
+    print("locdesc")
+
+
+    pd.DataFrame(crime_all, columns=["ppo", "violence"]).to_csv("ALL_DATA/crimetypes.csv", index=False)
+    LOADER.add_formatted_data("ALL_DATA/crimetypes.csv", "crimetype")
+    print("crimetype")
+
+
 crimetypes = SESSION.query(CrimeType).all()
 crimetype_dict = {}
 for c in crimetypes:
     crimetype_dict[(c.violence, c.ppo)] = c.id
-incidents.loc[:,"Crime Code Description"] = incidents.dropna(subset=["Crime Code Description"])
-incidents.loc[:,"crimetypeid"] = incidents["Crime Code Description"].apply(find_crimetypeid)
 loctypes = SESSION.query(LocationDescriptionType).all()
 loctype_dict = {}
 for c in loctypes:
     loctype_dict[c.locgroup] = c.id
-incidents.loc[:,"locdescid"] = incidents["Location Description"].apply(find_loctypeid)
-blocks = SESSION.query(Blocks).all()
-block_dict = {}
-for b in blocks:
-    block_dict[b.id] = wkb.loads(b.shape.data.tobytes())
-incidents.loc[:,"blockid"] = incidents["location"].apply(find_blockid)
-incidents.loc[:, "datetime"] = pd.to_datetime(incidents["Date Occurred"])
-incidents.loc[:, "hour"] = incidents["Time Occurred"].apply(lambda x: x)
-incidents.loc[:, "dow"] = incidents["datetime"].apply(lambda x: x.weekday())
-incidents.loc[:, "month"] = incidents["datetime"].apply(lambda x: x.month)
-incidents.loc[:, "year"] = incidents["datetime"].apply(lambda x: x.year)
-incidents.loc[:, "cityid"] = cityid
-incidents = incidents.loc[:,["crimetypeid", "locdescid", "cityid", "blockid", "location", "datetime", "hour", "dow", "month", "year"]]
-incidents = incidents.dropna()
-incidents.loc[:,"crimetypeid"] = incidents.loc[:,"crimetypeid"].astype(int)
-incidents.loc[:,"locdescid"] = incidents.loc[:,"locdescid"].astype(int)
-incidents.loc[:,"cityid"] = incidents.loc[:,"cityid"].astype(int)
-incidents.loc[:,"blockid"] = incidents.loc[:,"blockid"].astype(int)
-incidents.to_csv("ALL_DATA/LA_Data/incident.csv", index=False)
-print("\tuploading incidents")
-add_formatted_data("ALL_DATA/LA_Data/incident.csv", "incident")
-print("incidents")
\ No newline at end of file
+SESSION.close()
+LOADER.set_lookups((CRIMETYPE_DICT, find_crimetypeid), (LOCATION_DICT, find_loctypeid))
+LOADER.run()